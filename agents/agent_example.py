@@ -1,6 +1,8 @@
 import dmc
-import glob
 import numpy as np
+from pathlib import Path
+
+from replay_buffer import load_episodes
 
 class Agent:
     # An example of the agent to be implemented.
@@ -19,13 +21,8 @@ def load_data(data_path):
     """
     An example function to load the episodes in the 'data_path'.
     """
-    epss = sorted(glob.glob(f'{data_path}/*.npz'))
-    episodes = []
-    for eps in epss:
-        with open(eps, 'rb') as f:
-            episode = np.load(f)
-            episode = {k: episode[k] for k in episode.keys()}
-            episodes.append(episode)
+    epss = sorted(Path(data_path).glob('*.npz'))
+    episodes = list(load_episodes(epss, num_threads=4))
     print(len(episodes))
     return episodes
 
@@ -0,0 +1,75 @@
+import contextlib
+import copy
+import queue
+import threading
+import traceback
+
+import torch
+
+
+class AsyncShareSelector:
+    """Selects the share transitions of the coming updates in a background thread.
+
+    The worker draws share batches and runs `agent.select_share` on them with a snapshot of the critic,
+    so fetching and scoring overlap with the critic and actor updates of the training thread. The agent
+    refreshes the snapshot with `sync`; every selection carries the step of the snapshot that scored it.
+    On cuda the worker scores on its own stream and hands results over with events, without host syncs.
+    """
+
+    def __init__(self, agent, replay_iter_share, num_select, step):
+        self.agent = agent
+        self.replay_iter_share = replay_iter_share
+        self.num_select = num_select
+        self.cuda = torch.device(agent.device).type == 'cuda'
+        self.stream = torch.cuda.Stream() if self.cuda else None
+        self.ready = queue.Queue(maxsize=1)     # one selection ahead of the update that consumes it
+        self.lock = threading.Lock()
+        self.pending = None
+        self.error = None
+        self.sync(step)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def sync(self, step):
+        # a fresh copy each time: the worker may still be scoring with the previous one
+        snapshot = copy.deepcopy(self.agent.critic).eval().requires_grad_(False)
+        event = None
+        if self.cuda:
+            event = torch.cuda.Event()
+            event.record()
+        with self.lock:
+            self.pending = (snapshot, step, event)
+        self.synced_step = step
+
+    def _run(self):
+        try:
+            with torch.cuda.stream(self.stream) if self.cuda else contextlib.nullcontext():
+                while True:
+                    with self.lock:
+                        if self.pending is not None:
+                            self.snapshot, self.snapshot_step, event = self.pending
+                            self.pending = None
+                            if event is not None:
+                                self.stream.wait_event(event)    # the copy runs on the training stream
+                    batch_share = next(self.replay_iter_share)
+                    selected = self.agent.select_share(batch_share, self.num_select, self.replay_iter_share,
+                                                       critic=self.snapshot)
+                    event = None
+                    if self.cuda:
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    self.ready.put((selected, self.snapshot_step, event))
+        except:
+            self.error = traceback.format_exc()
+            self.ready.put(None)
+
+    def get(self):
+        # the next selection and the step of the critic snapshot that scored it
+        item = self.ready.get()
+        if item is None:
+            raise RuntimeError(f'asynchronous share selection failed:\n{self.error}')
+        selected, snapshot_step, event = item
+        if event is not None:
+            event.wait()
+            for x in selected:
+                x.record_stream(torch.cuda.current_stream())
+        return selected, snapshot_step
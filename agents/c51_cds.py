@@ -1,5 +1,6 @@
+import threading
+
 import hydra
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,14 +9,18 @@ from pathlib import Path
 
 import utils
 from dm_control.utils import rewards
-from agents.agent_example import Agent, load_data
+from agents.agent_example import load_data
+from agents.ensemble import EnsembleLayerNorm, EnsembleLinear, ensemble_q_net, head_norms, stack_heads
+from agents.share_scorer import ShareScorer
+from agents.share_select import ConservativeShareAgent
 
 def l2_projection(constraint):
     @torch.no_grad()
     def fn(module):
         if hasattr(module, 'weight') and constraint>0:
             w = module.weight
-            norm = torch.norm(w)
+            # stacked ensemble weights are projected per head
+            norm = head_norms(w) if isinstance(module, (EnsembleLinear, EnsembleLayerNorm)) else torch.norm(w)
             w.mul_(torch.clip(constraint/norm, max=1))
     return fn
 
@@ -68,7 +73,7 @@ class C51Q_network(nn.Module):
         return (dist * self.support).sum(-1)
 
 class Critic(nn.Module):
-    def __init__(self, obs_dim, action_dim, hidden_dim, atom_dim = 51, v_min = -50., v_max = 50. ,init_w=1e-3, device = 'cuda'):
+    def __init__(self, obs_dim, action_dim, hidden_dim, atom_dim = 51, v_min = -50., v_max = 50. ,init_w=1e-3, device = 'cuda', ensemble=False):
         super().__init__()
         self.device = device
         self.atom_dim= atom_dim
@@ -76,10 +81,17 @@ class Critic(nn.Module):
         self.delta_z = (v_max - v_min) / (atom_dim - 1)
         self.v_min = v_min
         self.v_max = v_max
-        self.q1 = C51Q_network(obs_dim, action_dim, hidden_dim, atom_dim, self.support)
-        self.q2 = C51Q_network(obs_dim, action_dim, hidden_dim, atom_dim, self.support)
+        self.ensemble = ensemble
+        if ensemble:
+            # both heads stacked in one network, evaluated with batched matmuls
+            self.q_net = ensemble_q_net(2, obs_dim + action_dim, hidden_dim, atom_dim).to(device)
+            return
+        self.q1 = C51Q_network(obs_dim, action_dim, hidden_dim, atom_dim, self.support, device)
+        self.q2 = C51Q_network(obs_dim, action_dim, hidden_dim, atom_dim, self.support, device)
         
     def forward(self, obs, action):
+        if self.ensemble:
+            return self.dist2q(*self.dist(obs, action))
         obs_action = torch.cat([obs, action], dim=-1)
         Q1 = self.q1(obs_action)
         Q2 = self.q2(obs_action)
@@ -87,12 +99,24 @@ class Critic(nn.Module):
     
     def dist(self, obs, action):
         obs_action = torch.cat([obs, action], dim=-1)
+        if self.ensemble:
+            q_atoms = self.q_net(obs_action.reshape(-1, obs_action.shape[-1])).unsqueeze(2)   # (2, batch_size, 1, atom_dim)
+            Q1_dist, Q2_dist = F.softmax(q_atoms, dim=-1).clamp(min=float(1e-3))
+            return Q1_dist, Q2_dist
         Q1_dist = self.q1.dist(obs_action)
         Q2_dist = self.q2.dist(obs_action)
         return Q1_dist, Q2_dist
 
     def dist2q(self, Q1_dist, Q2_dist):
+        if self.ensemble:
+            return (Q1_dist * self.support).sum(-1), (Q2_dist * self.support).sum(-1)
         return self.q1.dist2q(Q1_dist), self.q2.dist2q(Q2_dist)
+
+    def load_twin_state_dict(self, state_dict):
+        # load the state dict of a critic with separate heads into the stacked one
+        heads = [{k[len(f'{head}.net.'):]: v for k, v in state_dict.items() if k.startswith(f'{head}.net.')}
+                 for head in ['q1', 'q2']]
+        self.q_net.load_state_dict(stack_heads(heads))
     
     def dist_projection(self, optimal_dist, rewards, gamma):
         batch_size = rewards.shape[0]
@@ -111,7 +135,7 @@ class Critic(nn.Module):
         return m / m.sum(-1).unsqueeze(-1)
 
 
-class CDSAgent(Agent):
+class CDSAgent(ConservativeShareAgent):
     def __init__(self,
                  name,
                  obs_shape,
@@ -129,7 +153,16 @@ class CDSAgent(Agent):
                  target_cql_penalty,
                  use_critic_lagrange,
                  num_expl_steps,
-                 has_next_action=False):
+                 has_next_action=False,
+                 topk_on_device=True,
+                 share_reuse=1,
+                 async_share=False,
+                 share_sync_every=1,
+                 scorer_hidden_dim=None,
+                 scorer_lr=1e-3,
+                 scorer_distill_size=512,
+                 scorer_eval_every=100,
+                 ensemble_critic=False):
         self.num_expl_steps = num_expl_steps
         self.action_dim = action_shape[0]
         self.hidden_dim = hidden_dim
@@ -143,15 +176,30 @@ class CDSAgent(Agent):
 
         self.alpha = alpha
         self.n_samples = n_samples
+        self.topk_on_device = topk_on_device
+        self.share_reuse = share_reuse          # updates served by the selection of one share batch
+        self._share_batches = []
+        self.async_share = async_share          # fetch and score the next share batch in a background thread
+        self.share_sync_every = share_sync_every  # updates between refreshes of its critic snapshot
+        self._share_selector = None
+        self.scorer_distill_size = scorer_distill_size
+        self.scorer_eval_every = scorer_eval_every
+        self.scorer_metrics = dict()
+        self._scorer_lock = threading.Lock()    # the metrics are written by the selector thread
+        self._scorer_updates = 0
 
         state_dim = obs_shape[0]
         action_dim = action_shape[0]
 
         # models
         self.actor = Actor(state_dim, action_dim, hidden_dim).to(device)
-        self.critic = Critic(state_dim, action_dim, hidden_dim).to(device)
-        self.critic_target = Critic(state_dim, action_dim, hidden_dim).to(device)
+        self.critic = Critic(state_dim, action_dim, hidden_dim, device=device, ensemble=ensemble_critic).to(device)
+        self.critic_target = Critic(state_dim, action_dim, hidden_dim, device=device, ensemble=ensemble_critic).to(device)
         self.critic_target.load_state_dict(self.critic.state_dict())
+        # optional small network distilled from the critic, used only to rank share transitions
+        self.scorer = None
+        if scorer_hidden_dim:
+            self.scorer = ShareScorer(state_dim, action_dim, scorer_hidden_dim, scorer_lr).to(device)
 
         # lagrange multipliers
         self.target_entropy = -self.action_dim
@@ -183,25 +231,16 @@ class CDSAgent(Agent):
                 action.uniform_(-1.0, 1.0)
         return action.cpu().numpy()[0]
 
-    def _repeated_critic_apply(self, obs, actions):
+    def _repeated_critic_dist(self, obs, actions):
         """
             obs is (batch_size, obs_dim)
             actions is (n_samples, batch_size, action_dim)
 
-            output tensors are (n_samples, batch_size, 1)
+            output tensors are (n_samples, batch_size, 1, atom_dim)
         """
-        batch_size = obs.shape[0]
-        n_samples = actions.shape[0]
-
-        reshaped_actions = actions.reshape((n_samples * batch_size, -1))
-        repeated_obs = obs.unsqueeze(0).repeat((n_samples, 1, 1))
-        repeated_obs = repeated_obs.reshape((n_samples * batch_size, -1))
-
-        Q1, Q2 = self.critic(repeated_obs, reshaped_actions)
-        Q1 = Q1.reshape((n_samples, batch_size, 1))
-        Q2 = Q2.reshape((n_samples, batch_size, 1))
-
-        return Q1, Q2
+        # obs is broadcast over the samples, the critic's concatenation with the actions is its only copy
+        Q1_dist, Q2_dist = self.critic.dist(obs.expand(actions.shape[0], *obs.shape), actions)
+        return Q1_dist.view(*actions.shape[:2], *Q1_dist.shape[1:]), Q2_dist.view(*actions.shape[:2], *Q2_dist.shape[1:])
 
     def update_critic(self, obs, action, reward, discount, next_obs, step):
         metrics = dict()
@@ -219,37 +258,34 @@ class CDSAgent(Agent):
             target_dist = torch.cat([target_Q1_dist, target_Q2_dist], dim=1)
             target_dist = target_dist[batch, index]
             target_dist = self.critic.dist_projection(target_dist, reward, discount)
-            target_Q = reward + (discount * self.critic.q1.dist2q(target_dist))   # (1024,1)
+            target_Q = reward + (discount * (target_dist * self.critic.support).sum(-1))   # (1024,1)
             
 
         
-        Q1_dist, Q2_dist = self.critic.dist(obs, action)
-        Q1, Q2 = self.critic.dist2q(Q1_dist, Q2_dist)
-        # critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)   # 标量
-        critic_loss = F.cross_entropy(Q1_dist.squeeze(1), target_dist) + \
-                        F.cross_entropy(Q2_dist.squeeze(1), target_dist)
         # Add CQL penalty
         with torch.no_grad():
-            random_actions = torch.FloatTensor(self.n_samples, Q1.shape[0],
-                        action.shape[-1]).uniform_(-1, 1).to(self.device)    # (n_samples, 1024, act_dim)
+            random_actions = torch.empty(self.n_samples, *action.shape,
+                                         device=self.device).uniform_(-1, 1)   # (n_samples, 1024, act_dim)
             sampled_actions = self.actor(obs).sample(
                 sample_shape=(self.n_samples,))                              # (n_samples, 1024, act_dim)
             # print("sampled_actions:", sampled_actions.shape)
             next_sampled_actions = self.actor(next_obs).sample(
                 sample_shape=(self.n_samples,))                              # (n_samples, 1024, act_dim)
             # print("next_sampled_actions:", next_sampled_actions.shape)
+            # the penalty's candidate actions and the data actions, evaluated in one critic forward
+            cat_actions = torch.cat([random_actions, sampled_actions, next_sampled_actions,
+                                     action.unsqueeze(0)], dim=0)            # (1+3*n_samples, 1024, act_dim)
 
-        rand_Q1, rand_Q2 = self._repeated_critic_apply(obs, random_actions)  # (n_samples, 1024, 1)
-        sampled_Q1, sampled_Q2 = self._repeated_critic_apply(                # (n_samples, 1024, 1)
-            obs, sampled_actions)
-        next_sampled_Q1, next_sampled_Q2 = self._repeated_critic_apply(      # (n_samples, 1024, 1)
-            obs, next_sampled_actions)
+        cat_Q1_dist, cat_Q2_dist = self._repeated_critic_dist(obs, cat_actions)  # (1+3*n_samples, 1024, 1, atom_dim)
+        Q1_dist, Q2_dist = cat_Q1_dist[-1], cat_Q2_dist[-1]
+        Q1, Q2 = self.critic.dist2q(Q1_dist, Q2_dist)
+        # critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)   # 标量
+        critic_loss = F.cross_entropy(Q1_dist.squeeze(1), target_dist) + \
+                        F.cross_entropy(Q2_dist.squeeze(1), target_dist)
 
         # situation 1
-        cat_Q1 = torch.cat([rand_Q1, sampled_Q1, next_sampled_Q1,
-                            Q1.unsqueeze(0)], dim=0)                # (1+3*n_samples, 1024, 1)
-        cat_Q2 = torch.cat([rand_Q2, sampled_Q2, next_sampled_Q2,
-                            Q2.unsqueeze(0)], dim=0)                # (1+3*n_samples, 1024, 1)
+        cat_Q1, cat_Q2 = self.critic.dist2q(cat_Q1_dist, cat_Q2_dist)  # (1+3*n_samples, 1024, 1)
+        rand_Q1, sampled_Q1 = cat_Q1[:self.n_samples], cat_Q1[self.n_samples:2 * self.n_samples]
 
         assert (not torch.isnan(cat_Q1).any()) and (not torch.isnan(cat_Q2).any())
 
@@ -338,52 +374,18 @@ class CDSAgent(Agent):
 
         return metrics
 
-    # TODO: conservative data sharing
-    def conservative_data_share(self, batch_main, batch_share):
-        obs_all, action_all, next_obs_all, reward_all, discount_all, obs_k_all = [], [], [], [], [], []
-
-        # 1. sample examples from the main task
-        # shape = (512, 24), (512, 6), (512, 1), (512, 1), (512, 24)
-        obs_m, action_m, reward_m, discount_m, next_obs_m, _ = utils.to_torch(batch_main, self.device)
-        # print("main samples:", obs_m.shape, action_m.shape, reward_m.shape, discount_m.shape, next_obs_m.shape, eps_flag_m.shape)
-        obs_all.append(obs_m)
-        action_all.append(action_m)
-        next_obs_all.append(next_obs_m)
-        reward_all.append(reward_m)
-        discount_all.append(discount_m)
-
-        # 2. sample examples from other tasks
-        # sample 10 times samples, and select the top-0.1 samples.   (batch_size_split*10, xx, xx)
-        # shape = (5120, 24) (5120, 6) (5120, 1) (5120, 1) (5120, 24)
-        obs, action, reward, discount, next_obs, _ = utils.to_torch(batch_share, self.device)
-        # print("obs:", obs.shape, action.shape, reward.shape, discount.shape, next_obs.shape)
-        # calculate the conservative Q value
-        with torch.no_grad():
-            conservative_q_value, _ = self.critic(obs, action)          # (5120, 1)
-        conservative_q_value = conservative_q_value.squeeze().detach().cpu().numpy()
-        # choose the top 0.1  top_index.shape=(512,)
-        top_index = np.argpartition(conservative_q_value, -obs_m.shape[0])[-obs_m.shape[0]:]  # find the top 0.1 index. (batch_size_split,)
-        # extract the samples
-        obs_all.append(obs[top_index])
-        action_all.append(action[top_index])
-        next_obs_all.append(next_obs[top_index])
-        reward_all.append(reward[top_index])
-        discount_all.append(discount[top_index])
-
-        return torch.cat(obs_all, dim=0), torch.cat(action_all, dim=0), torch.cat(reward_all, dim=0), \
-            torch.cat(discount_all, dim=0), torch.cat(next_obs_all, dim=0)
-
     def update(self, replay_iter_main, replay_iter_share, step, total_step):
         metrics = dict()
 
         batch_main = next(replay_iter_main)  # len=6, inner_shape=512x24
-        batch_share = next(replay_iter_share)
-
         # print("conservative data sharing...")   # obs.shape=(1024, 24), action.shape=(1024, 6) reward.shape=(1024, 1)
-        obs, action, reward, discount, next_obs = self.conservative_data_share(batch_main, batch_share)
+        obs, action, reward, discount, next_obs = self.share_batch(batch_main, replay_iter_share, step, metrics)
 
         if self.use_tb:
             metrics['batch_reward'] = reward.mean().item()
+            with self._scorer_lock:
+                scorer_metrics, self.scorer_metrics = self.scorer_metrics, dict()
+            metrics.update(scorer_metrics)
 
         # update critic
         metrics.update(
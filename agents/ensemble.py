@@ -0,0 +1,69 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class EnsembleLinear(nn.Module):
+    """nn.Linear of `num_heads` heads with stacked weights, evaluated with one batched matmul.
+
+    Inputs are (num_heads, batch_size, in_dim), or (batch_size, in_dim) shared by all heads.
+    """
+
+    def __init__(self, num_heads, in_dim, out_dim):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(num_heads, in_dim, out_dim))
+        self.bias = nn.Parameter(torch.empty(num_heads, 1, out_dim))
+        # the default init of nn.Linear, for each head
+        bound = 1 / math.sqrt(in_dim)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        if x.dim() == 2:
+            x = x.expand(self.weight.shape[0], *x.shape)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleLayerNorm(nn.Module):
+    """nn.LayerNorm over the last dimension with a separate affine transform per head."""
+
+    def __init__(self, num_heads, dim, eps=1e-5):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(num_heads, 1, dim))
+        self.bias = nn.Parameter(torch.zeros(num_heads, 1, dim))
+
+    def forward(self, x):
+        return torch.addcmul(self.bias, F.layer_norm(x, x.shape[-1:], eps=self.eps), self.weight)
+
+
+def ensemble_q_net(num_heads, in_dim, hidden_dim, out_dim):
+    # the layout of the critics' per-head nn.Sequential stacks, for all heads at once: (num_heads, batch_size, out_dim)
+    return nn.Sequential(
+        EnsembleLinear(num_heads, in_dim, hidden_dim), EnsembleLayerNorm(num_heads, hidden_dim), nn.Tanh(),
+        EnsembleLinear(num_heads, hidden_dim, hidden_dim), EnsembleLayerNorm(num_heads, hidden_dim), nn.LeakyReLU(),
+        EnsembleLinear(num_heads, hidden_dim, hidden_dim), nn.LeakyReLU(),
+        EnsembleLinear(num_heads, hidden_dim, out_dim))
+
+
+def stack_heads(head_state_dicts):
+    """State dict of an ensemble_q_net from the state dicts of per-head nn.Sequential stacks of the same layout.
+
+    nn.Linear weights are (out_dim, in_dim) and are transposed; all parameters get a leading head dimension
+    and biases and LayerNorm weights a broadcast dimension over the batch.
+    """
+    state_dict = dict()
+    for key in head_state_dicts[0]:
+        params = [sd[key] for sd in head_state_dicts]
+        if key.endswith('weight') and params[0].dim() == 2:
+            state_dict[key] = torch.stack([p.t() for p in params])
+        else:
+            state_dict[key] = torch.stack(params).unsqueeze(1)
+    return state_dict
+
+
+def head_norms(weight):
+    # l2 norm of each head's slice of a stacked parameter, broadcastable against it
+    return weight.flatten(1).norm(dim=1).view(-1, *[1] * (weight.dim() - 1))
@@ -1,14 +1,19 @@
+import threading
+
 import hydra
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from collections import OrderedDict
 from pathlib import Path
+from torch.utils.checkpoint import checkpoint
 
 import utils
 from dm_control.utils import rewards
-from agents.agent_example import Agent, load_data
+from agents.agent_example import load_data
+from agents.ensemble import ensemble_q_net, stack_heads
+from agents.share_scorer import ShareScorer
+from agents.share_select import ConservativeShareAgent
 
 
 class Actor(nn.Module):
@@ -36,9 +41,14 @@ class Actor(nn.Module):
 
 
 class Critic(nn.Module):
-    def __init__(self, obs_dim, action_dim, hidden_dim, particle_num=32, init_w=1e-3):
+    def __init__(self, obs_dim, action_dim, hidden_dim, particle_num=32, init_w=1e-3, ensemble=False):
         super().__init__()
         self.particle_num = particle_num
+        self.ensemble = ensemble
+        if ensemble:
+            # both heads stacked in one network, evaluated with batched matmuls
+            self.q_net = ensemble_q_net(2, obs_dim + action_dim, hidden_dim, particle_num)
+            return
         self.q1_net = nn.Sequential(
             nn.Linear(obs_dim + action_dim, hidden_dim), nn.LayerNorm(hidden_dim), nn.Tanh(),
             nn.Linear(hidden_dim, hidden_dim), nn.LayerNorm(hidden_dim), nn.LeakyReLU(),
@@ -53,6 +63,9 @@ class Critic(nn.Module):
 
     def dist(self, obs, action):
         obs_action = torch.cat([obs, action], dim=-1)
+        if self.ensemble:
+            q1, q2 = self.q_net(obs_action.reshape(-1, obs_action.shape[-1])).view(2, *obs_action.shape[:-1], -1)
+            return q1, q2
         q1 = self.q1_net(obs_action)
         q1 = self.q1_last(q1)
 
@@ -64,11 +77,20 @@ class Critic(nn.Module):
     def forward(self, obs, action):
         q1, q2 = self.dist(obs, action)
         return q1.mean(-1).unsqueeze(-1), q2.mean(-1).unsqueeze(-1)
+
+    def load_twin_state_dict(self, state_dict):
+        # load the state dict of a critic with separate heads into the stacked one
+        heads = []
+        for head in ['q1', 'q2']:
+            heads.append({k[len(f'{head}_net.'):]: v for k, v in state_dict.items() if k.startswith(f'{head}_net.')})
+            heads[-1].update({'8.' + k[len(f'{head}_last.'):]: v for k, v in state_dict.items()
+                              if k.startswith(f'{head}_last.')})
+        self.q_net.load_state_dict(stack_heads(heads))
     
     
 
 
-class CDSAgent(Agent):
+class CDSAgent(ConservativeShareAgent):
     def __init__(self,
                  name,
                  obs_shape,
@@ -86,7 +108,19 @@ class CDSAgent(Agent):
                  target_cql_penalty,
                  use_critic_lagrange,
                  num_expl_steps,
-                 has_next_action=False):
+                 has_next_action=False,
+                 topk_on_device=True,
+                 share_reuse=1,
+                 async_share=False,
+                 share_sync_every=1,
+                 scorer_hidden_dim=None,
+                 scorer_lr=1e-3,
+                 scorer_distill_size=512,
+                 scorer_eval_every=100,
+                 particle_num=32,
+                 mmd_chunk_mb=None,
+                 mmd_estimator='quadratic',
+                 ensemble_critic=False):
         self.num_expl_steps = num_expl_steps
         self.action_dim = action_shape[0]
         self.hidden_dim = hidden_dim
@@ -100,15 +134,38 @@ class CDSAgent(Agent):
 
         self.alpha = alpha
         self.n_samples = n_samples
+        self.topk_on_device = topk_on_device
+        self.share_reuse = share_reuse          # updates served by the selection of one share batch
+        self._share_batches = []
+        self.async_share = async_share          # fetch and score the next share batch in a background thread
+        self.share_sync_every = share_sync_every  # updates between refreshes of its critic snapshot
+        self._share_selector = None
+        self.scorer_distill_size = scorer_distill_size
+        self.scorer_eval_every = scorer_eval_every
+        self.scorer_metrics = dict()
+        self._scorer_lock = threading.Lock()    # the metrics are written by the selector thread
+        self._scorer_updates = 0
+        self.mmd_chunk_mb = mmd_chunk_mb        # memory budget of the pairwise mmd kernels
+        assert mmd_estimator in ['quadratic', 'linear']
+        # the linear estimator pairs disjoint particles, of which there are none with a single particle
+        assert mmd_estimator != 'linear' or particle_num >= 2, 'the linear mmd estimator needs particle_num >= 2'
+        self.mmd_estimator = mmd_estimator
 
         state_dim = obs_shape[0]
         action_dim = action_shape[0]
 
         # models
         self.actor = Actor(state_dim, action_dim, hidden_dim).to(device)
-        self.critic = Critic(state_dim, action_dim, hidden_dim).to(device)
-        self.critic_target = Critic(state_dim, action_dim, hidden_dim).to(device)
+        self.critic = Critic(state_dim, action_dim, hidden_dim, particle_num, ensemble=ensemble_critic).to(device)
+        self.critic_target = Critic(state_dim, action_dim, hidden_dim, particle_num, ensemble=ensemble_critic).to(device)
         self.critic_target.load_state_dict(self.critic.state_dict())
+        # mmd kernel bandwidths 2 * (2 ** i) ** 2 for i < 20
+        kernel_bandwidths = 2 * (2 ** torch.arange(20, dtype=torch.float64)) ** 2
+        self.kernel_inv_bandwidth = (1 / kernel_bandwidths).sum().float().to(device)
+        # optional small network distilled from the critic, used only to rank share transitions
+        self.scorer = None
+        if scorer_hidden_dim:
+            self.scorer = ShareScorer(state_dim, action_dim, scorer_hidden_dim, scorer_lr).to(device)
 
         # lagrange multipliers
         self.target_entropy = -self.action_dim
@@ -140,43 +197,71 @@ class CDSAgent(Agent):
                 action.uniform_(-1.0, 1.0)
         return action.cpu().numpy()[0]
 
-    def _repeated_critic_apply(self, obs, actions):
+    def _repeated_critic_dist(self, obs, actions):
         """
             obs is (batch_size, obs_dim)
             actions is (n_samples, batch_size, action_dim)
 
-            output tensors are (n_samples, batch_size, 1)
+            output tensors are (n_samples, batch_size, particle_num)
+        """
+        # obs is broadcast over the samples, the critic's concatenation with the actions is its only copy
+        return self.critic.dist(obs.expand(actions.shape[0], *obs.shape), actions)
+
+    def _kernel(self, A, B):
+        # the terms of all bandwidths are linear in the squared distance, so they fold into one coefficient
+        return (A.unsqueeze(-1) - B.unsqueeze(-2)).pow(2) * -self.kernel_inv_bandwidth
+
+    def _mmd_sums(self, X, Y, block):
+        # per-row mmd kernel sums, the first particle index of the Y terms in blocks of `block` particles
+        first_item, third_item = 0, 0
+        for i in range(0, Y.shape[-1], block):
+            first_item = first_item + self._kernel(Y[..., i:i + block], Y).sum((-1, -2))
+            third_item = third_item + self._kernel(Y[..., i:i + block], X).sum((-1, -2))
+        return first_item + self._kernel(X, X).sum((-1, -2)) - 2 * third_item
+
+    def mmd_loss(self, X, Y):
         """
-        batch_size = obs.shape[0]
-        n_samples = actions.shape[0]
-
-        reshaped_actions = actions.reshape((n_samples * batch_size, -1))
-        repeated_obs = obs.unsqueeze(0).repeat((n_samples, 1, 1))
-        repeated_obs = repeated_obs.reshape((n_samples * batch_size, -1))
-
-        Q1, Q2 = self.critic(repeated_obs, reshaped_actions)
-        Q1 = Q1.reshape((n_samples, batch_size, 1))
-        Q2 = Q2.reshape((n_samples, batch_size, 1))
-
-        return Q1, Q2
-
-    def calc_kernel(self, X, Y, kernel_num=20):
-        first_kernel = (Y.unsqueeze(-1) - Y.unsqueeze(-2)).pow(2)
-        second_kernel = (X.unsqueeze(-1) - X.unsqueeze(-2)).pow(2)
-        third_kernel = (Y.unsqueeze(-1) - X.unsqueeze(-2)).pow(2)
-        bandwidth_list = [2 ** i for i in range(kernel_num)]
-        first_items = 0
-        second_items = 0
-        third_items = 0
-        for h in bandwidth_list:
-            h = 2 * (h ** 2)
-            first_inner_distance = (-first_kernel / h)
-            second_inner_distance = (-second_kernel / h)
-            intra_distance = (-third_kernel / h)
-            first_items += first_inner_distance
-            second_items += second_inner_distance
-            third_items += intra_distance
-        return first_items, second_items, third_items
+            X is (batch_size, n) target particles
+            Y is (heads, batch_size, particle_num) critic particles of all heads
+
+            output is the sum over heads of the batch mean mmd loss
+        """
+        heads, batch_size, particle_num = Y.shape
+        if self.mmd_chunk_mb is None:
+            mmd = self._mmd_sums(X, Y, particle_num)
+        else:
+            # pairwise kernels of at most mmd_chunk_mb (float32) at a time: blocks of particles within a
+            # row, several rows per chunk, each chunk recomputed in backward instead of kept for it
+            budget = max(1, int(self.mmd_chunk_mb * 2 ** 20 / 4))
+            block = min(particle_num, max(1, budget // (heads * particle_num)))
+            rows = max(1, budget // (heads * block * particle_num))
+            chunks = []
+            for i in range(0, batch_size, rows):
+                X_chunk, Y_chunk = X[i:i + rows], Y[:, i:i + rows]
+                if torch.is_grad_enabled() and Y.requires_grad:
+                    chunks.append(checkpoint(self._mmd_sums, X_chunk, Y_chunk, block, use_reentrant=False))
+                else:
+                    chunks.append(self._mmd_sums(X_chunk, Y_chunk, block))
+            mmd = torch.cat(chunks, dim=-1)
+        return (mmd / (particle_num ** 2)).mean(-1).sum()
+
+    def linear_mmd_loss(self, X, Y):
+        """
+            linear-time estimate of mmd_loss from disjoint particle pairs, shapes as in mmd_loss
+
+            output is the loss and the mean variance of the per-row estimates
+        """
+        particle_num, n = Y.shape[-1], X.shape[-1]
+        perm = torch.randperm(particle_num - particle_num % 2, device=Y.device)
+        i, j = perm[0::2], perm[1::2]
+        x_i, x_j = X[..., i % n], X[..., j % n]
+        y_i, y_j = Y[..., i], Y[..., j]
+        # mmd_loss normalizes every term by particle_num ** 2, so the target terms are weighted by n / particle_num
+        w = n / particle_num
+        h = -self.kernel_inv_bandwidth * ((y_i - y_j).pow(2) + w ** 2 * (x_i - x_j).pow(2)
+                                          - w * ((y_i - x_j).pow(2) + (y_j - x_i).pow(2)))
+        mmd_var = h.detach().var(-1) / h.shape[-1]
+        return h.mean(-1).mean(-1).sum(), mmd_var.mean()
 
     def update_critic(self, obs, action, reward, discount, next_obs, step):
         metrics = dict()
@@ -190,43 +275,36 @@ class CDSAgent(Agent):
             target_V = torch.min(target_Q1, target_Q2)  # (1024,1)
             target_Q = reward + (discount * target_V)   # (1024,1)
 
-        Q1_dist, Q2_dist = self.critic.dist(obs, action)
-        Q1 = Q1_dist.mean(-1).unsqueeze(-1)
-        Q2  = Q2_dist.mean(-1).unsqueeze(-1)
-        particle_num = self.critic.particle_num
-
-        X = target_Q
-        critic_loss = 0
-        for Y in [Q1_dist, Q2_dist]:
-            first_item, second_item, third_item = self.calc_kernel(X, Y)
-            first_item = (first_item.sum(-1).sum(-1) / (particle_num ** 2)).mean()
-            second_item = (second_item.sum(-1).sum(-1) / (particle_num ** 2)).mean()
-            third_item = (third_item.sum(-1).sum(-1) / (particle_num ** 2)).mean()
-            critic_loss += first_item + second_item - 2 * third_item
-        # critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)   # 标量
-
         # Add CQL penalty
         with torch.no_grad():
-            random_actions = torch.FloatTensor(self.n_samples, Q1.shape[0],
-                        action.shape[-1]).uniform_(-1, 1).to(self.device)    # (n_samples, 1024, act_dim)
+            random_actions = torch.empty(self.n_samples, *action.shape,
+                                         device=self.device).uniform_(-1, 1)   # (n_samples, 1024, act_dim)
             sampled_actions = self.actor(obs).sample(
                 sample_shape=(self.n_samples,))                              # (n_samples, 1024, act_dim)
             # print("sampled_actions:", sampled_actions.shape)
             next_sampled_actions = self.actor(next_obs).sample(
                 sample_shape=(self.n_samples,))                              # (n_samples, 1024, act_dim)
             # print("next_sampled_actions:", next_sampled_actions.shape)
+            # the penalty's candidate actions and the data actions, evaluated in one critic forward
+            cat_actions = torch.cat([random_actions, sampled_actions, next_sampled_actions,
+                                     action.unsqueeze(0)], dim=0)            # (1+3*n_samples, 1024, act_dim)
+
+        cat_Q1_dist, cat_Q2_dist = self._repeated_critic_dist(obs, cat_actions)  # (1+3*n_samples, 1024, particle_num)
+        Q1_dist, Q2_dist = cat_Q1_dist[-1], cat_Q2_dist[-1]
+        Q1 = Q1_dist.mean(-1).unsqueeze(-1)
+        Q2  = Q2_dist.mean(-1).unsqueeze(-1)
+
+        if self.mmd_estimator == 'linear':
+            critic_loss, mmd_var = self.linear_mmd_loss(target_Q, torch.stack([Q1_dist, Q2_dist]))
+        else:
+            critic_loss = self.mmd_loss(target_Q, torch.stack([Q1_dist, Q2_dist]))   # both heads in one pass
+        # critic_loss = F.mse_loss(Q1, target_Q) + F.mse_loss(Q2, target_Q)   # 标量
 
-        rand_Q1, rand_Q2 = self._repeated_critic_apply(obs, random_actions)  # (n_samples, 1024, 1)
-        sampled_Q1, sampled_Q2 = self._repeated_critic_apply(                # (n_samples, 1024, 1)
-            obs, sampled_actions)
-        next_sampled_Q1, next_sampled_Q2 = self._repeated_critic_apply(      # (n_samples, 1024, 1)
-            obs, next_sampled_actions)
 
         # situation 1
-        cat_Q1 = torch.cat([rand_Q1, sampled_Q1, next_sampled_Q1,
-                            Q1.unsqueeze(0)], dim=0)                # (1+3*n_samples, 1024, 1)
-        cat_Q2 = torch.cat([rand_Q2, sampled_Q2, next_sampled_Q2,
-                            Q2.unsqueeze(0)], dim=0)                # (1+3*n_samples, 1024, 1)
+        cat_Q1 = cat_Q1_dist.mean(-1).unsqueeze(-1)                  # (1+3*n_samples, 1024, 1)
+        cat_Q2 = cat_Q2_dist.mean(-1).unsqueeze(-1)                  # (1+3*n_samples, 1024, 1)
+        rand_Q1, sampled_Q1 = cat_Q1[:self.n_samples], cat_Q1[self.n_samples:2 * self.n_samples]
 
         assert (not torch.isnan(cat_Q1).any()) and (not torch.isnan(cat_Q2).any())
 
@@ -264,6 +342,8 @@ class CDSAgent(Agent):
             metrics['critic_q1'] = Q1.mean().item()
             # metrics['critic_q2'] = Q2.mean().item()
             metrics['critic_loss'] = critic_loss.item()
+            if self.mmd_estimator == 'linear':
+                metrics['critic_mmd_var'] = mmd_var.item()
             metrics['critic_cql'] = cql_penalty.item()
             metrics['critic_cql_logsum1'] = cql_logsumexp1.item()
             # metrics['critic_cql_logsum2'] = cql_logsumexp1.item()
@@ -313,52 +393,18 @@ class CDSAgent(Agent):
 
         return metrics
 
-    # TODO: conservative data sharing
-    def conservative_data_share(self, batch_main, batch_share):
-        obs_all, action_all, next_obs_all, reward_all, discount_all, obs_k_all = [], [], [], [], [], []
-
-        # 1. sample examples from the main task
-        # shape = (512, 24), (512, 6), (512, 1), (512, 1), (512, 24)
-        obs_m, action_m, reward_m, discount_m, next_obs_m, _ = utils.to_torch(batch_main, self.device)
-        # print("main samples:", obs_m.shape, action_m.shape, reward_m.shape, discount_m.shape, next_obs_m.shape, eps_flag_m.shape)
-        obs_all.append(obs_m)
-        action_all.append(action_m)
-        next_obs_all.append(next_obs_m)
-        reward_all.append(reward_m)
-        discount_all.append(discount_m)
-
-        # 2. sample examples from other tasks
-        # sample 10 times samples, and select the top-0.1 samples.   (batch_size_split*10, xx, xx)
-        # shape = (5120, 24) (5120, 6) (5120, 1) (5120, 1) (5120, 24)
-        obs, action, reward, discount, next_obs, _ = utils.to_torch(batch_share, self.device)
-        # print("obs:", obs.shape, action.shape, reward.shape, discount.shape, next_obs.shape)
-        # calculate the conservative Q value
-        with torch.no_grad():
-            conservative_q_value, _ = self.critic(obs, action)          # (5120, 1)
-        conservative_q_value = conservative_q_value.squeeze().detach().cpu().numpy()
-        # choose the top 0.1  top_index.shape=(512,)
-        top_index = np.argpartition(conservative_q_value, -obs_m.shape[0])[-obs_m.shape[0]:]  # find the top 0.1 index. (batch_size_split,)
-        # extract the samples
-        obs_all.append(obs[top_index])
-        action_all.append(action[top_index])
-        next_obs_all.append(next_obs[top_index])
-        reward_all.append(reward[top_index])
-        discount_all.append(discount[top_index])
-
-        return torch.cat(obs_all, dim=0), torch.cat(action_all, dim=0), torch.cat(reward_all, dim=0), \
-            torch.cat(discount_all, dim=0), torch.cat(next_obs_all, dim=0)
-
     def update(self, replay_iter_main, replay_iter_share, step, total_step):
         metrics = dict()
 
         batch_main = next(replay_iter_main)  # len=6, inner_shape=512x24
-        batch_share = next(replay_iter_share)
-
         # print("conservative data sharing...")   # obs.shape=(1024, 24), action.shape=(1024, 6) reward.shape=(1024, 1)
-        obs, action, reward, discount, next_obs = self.conservative_data_share(batch_main, batch_share)
+        obs, action, reward, discount, next_obs = self.share_batch(batch_main, replay_iter_share, step, metrics)
 
         if self.use_tb:
             metrics['batch_reward'] = reward.mean().item()
+            with self._scorer_lock:
+                scorer_metrics, self.scorer_metrics = self.scorer_metrics, dict()
+            metrics.update(scorer_metrics)
 
         # update critic
         metrics.update(
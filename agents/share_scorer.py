@@ -0,0 +1,41 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ShareScorer(nn.Module):
+    """Small Q network distilled online from the critic's conservative Q.
+
+    It is only used to rank share transitions for conservative data sharing, in place of a forward pass of
+    the full twin-head critic over every candidate. `distill` regresses it onto standardized critic Q values
+    of a few candidates per step; `agreement` compares its ranking with the critic's.
+    """
+
+    def __init__(self, obs_dim, action_dim, hidden_dim, lr):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Linear(obs_dim + action_dim, hidden_dim), nn.LayerNorm(hidden_dim), nn.Tanh(),
+            nn.Linear(hidden_dim, hidden_dim), nn.LeakyReLU(),
+            nn.Linear(hidden_dim, 1))
+        self.opt = torch.optim.Adam(self.parameters(), lr=lr)
+
+    def forward(self, obs, action):
+        return self.net(torch.cat([obs, action], dim=-1))
+
+    def distill(self, obs, action, target_q):
+        # only the ranking matters: regressing standardized targets keeps up with the growing scale of the critic
+        target_q = (target_q - target_q.mean()) / (target_q.std() + 1e-6)
+        loss = F.mse_loss(self(obs, action), target_q)
+        self.opt.zero_grad(set_to_none=True)
+        loss.backward()
+        self.opt.step()
+        return loss.detach()
+
+    @staticmethod
+    def agreement(scores, q, k):
+        # fraction of the scorer's top k that is in the critic's top k, and the correlation of both
+        top_scores = torch.topk(scores, k, sorted=False).indices
+        top_q = torch.topk(q, k, sorted=False).indices
+        topk_agreement = torch.isin(top_scores, top_q).float().mean()
+        corr = torch.corrcoef(torch.stack([scores, q]))[0, 1]
+        return topk_agreement, corr
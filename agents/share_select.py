@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+
+import utils
+from agents.agent_example import Agent
+from agents.async_share import AsyncShareSelector
+from replay_buffer import PrioritizedReplayBuffer, ScoredReplayBuffer
+
+
+class ConservativeShareAgent(Agent):
+    """Conservative data sharing of the CDS agents: the share transitions each update trains on.
+
+    Subclasses set `critic`, `device`, `use_tb`, `topk_on_device`, `scorer` and the share_reuse, async_share
+    and scorer settings in their constructor. The kind of share batch is told by the share buffer it comes from:
+    a PrioritizedReplayBuffer batch is drawn by conservative Q already and carries its leaf indices, a
+    ScoredReplayBuffer batch holds top transitions of the cached scores, any other batch is scored here and
+    its top transitions are kept.
+    """
+
+    # TODO: conservative data sharing
+    def conservative_data_share(self, batch_main, batch_share, share_buffer=None):
+        # the main batch followed by the top share transitions of a batch drawn from share_buffer
+        num_select = len(batch_main[0])
+        return self.merge_share(batch_main, self.select_share(batch_share, num_select, share_buffer))
+
+    def merge_share(self, batch_main, selected):
+        # 1. sample examples from the main task
+        # shape = (512, 24), (512, 6), (512, 1), (512, 1), (512, 24)
+        obs_m, action_m, reward_m, discount_m, next_obs_m, _ = utils.to_torch(batch_main, self.device)
+        # 2. sample examples from other tasks, selected by select_share
+        obs, action, reward, discount, next_obs = selected
+        return torch.cat([obs_m, obs], dim=0), torch.cat([action_m, action], dim=0), \
+            torch.cat([reward_m, reward], dim=0), torch.cat([discount_m, discount], dim=0), \
+            torch.cat([next_obs_m, next_obs], dim=0)
+
+    def select_share(self, batch_share, num_select, share_buffer=None, critic=None):
+        critic = self.critic if critic is None else critic      # a snapshot when selecting asynchronously
+        # sample 10 times samples, and select the top-0.1 samples.   (batch_size_split*10, xx, xx)
+        # shape = (5120, 24) (5120, 6) (5120, 1) (5120, 1) (5120, 24)
+        obs, action, reward, discount, next_obs, _ = utils.to_torch(batch_share[:6], self.device)
+        if isinstance(share_buffer, ScoredReplayBuffer):
+            # drawn from the top transitions of the cached scores, nothing to score here
+            top_index = np.arange(obs.shape[0])
+        else:
+            # calculate the conservative Q value
+            with torch.no_grad():
+                if self.scorer is None:
+                    conservative_q_value, _ = critic(obs, action)          # (5120, 1)
+                else:
+                    conservative_q_value = self.scorer(obs, action)
+            conservative_q_value = conservative_q_value.squeeze(-1)
+            if self.scorer is not None:
+                self._distill_scorer(obs, action, conservative_q_value, critic, num_select)
+            if isinstance(share_buffer, PrioritizedReplayBuffer):
+                # the batch is already drawn by conservative Q, keep all of it and report the new Q of its leaves
+                share_buffer.update_priorities(batch_share[6], conservative_q_value.cpu().numpy())
+                top_index = np.arange(obs.shape[0])
+            elif self.topk_on_device:
+                # choose the top 0.1 on the device, so neither the Q values nor the indices go through the host
+                top_index = torch.topk(conservative_q_value, num_select, sorted=False).indices
+            else:
+                # choose the top 0.1  top_index.shape=(512,)
+                conservative_q_value = conservative_q_value.cpu().numpy()
+                top_index = np.argpartition(conservative_q_value, -num_select)[-num_select:]  # find the top 0.1 index. (batch_size_split,)
+        # extract the samples
+        return obs[top_index], action[top_index], reward[top_index], discount[top_index], next_obs[top_index]
+
+    def _distill_scorer(self, obs, action, scores, critic, num_select):
+        # regress the scorer onto the critic's conservative Q of a random subset of the share candidates
+        idx = torch.randint(obs.shape[0], (min(self.scorer_distill_size, obs.shape[0]),), device=obs.device)
+        with torch.no_grad():
+            target_q, _ = critic(obs[idx], action[idx])
+        loss = self.scorer.distill(obs[idx], action[idx], target_q)
+        self._scorer_updates += 1
+        if self.use_tb and self._scorer_updates % self.scorer_eval_every == 0:
+            # agreement with the critic over all candidates, for the top fraction conservative data sharing keeps
+            with torch.no_grad():
+                q, _ = critic(obs, action)
+            k = num_select if num_select < obs.shape[0] else max(1, obs.shape[0] // 10)
+            topk_agreement, corr = self.scorer.agreement(scores, q.squeeze(-1), k)
+            with self._scorer_lock:
+                self.scorer_metrics = dict(scorer_loss=loss.item(), scorer_topk_agreement=topk_agreement.item(),
+                                           scorer_corr=corr.item())
+
+    def conservative_score(self, obs, action):
+        # conservative Q of a chunk of share transitions, numpy in and out (see ScoredReplayBuffer.refresh)
+        obs, action = utils.to_torch((obs, action), self.device)
+        with torch.no_grad():
+            conservative_q_value, _ = self.critic(obs, action)
+        return conservative_q_value.squeeze(-1).cpu().numpy()
+
+    def share_batch(self, batch_main, replay_iter_share, step, metrics):
+        # the main batch and the share transitions of this update, merged; writes the share metrics into metrics
+        if isinstance(replay_iter_share, ScoredReplayBuffer):
+            if replay_iter_share.refresh(step, self.conservative_score) and self.use_tb:
+                metrics['share_score_threshold'] = float(replay_iter_share.threshold)
+        if self.share_reuse > 1 or self.async_share:
+            if self._share_selector is not None and step - self._share_selector.synced_step >= self.share_sync_every:
+                # on every update, not only when the next selection is taken
+                self._share_selector.sync(step)
+            if len(self._share_batches) == 0:
+                # score one share batch share_reuse times as large, and spread its top transitions over the next updates
+                num_select = len(batch_main[0]) * self.share_reuse
+                if self.async_share:
+                    # selected in the background with a critic snapshot, while the previous updates ran
+                    if self._share_selector is None:
+                        self._share_selector = AsyncShareSelector(self, replay_iter_share, num_select, step)
+                    selected, snapshot_step = self._share_selector.get()
+                    if self.use_tb:
+                        metrics['share_snapshot_lag'] = step - snapshot_step
+                else:
+                    selected = self.select_share(next(replay_iter_share), num_select, replay_iter_share)
+                if self.share_reuse > 1:
+                    perm = torch.randperm(selected[0].shape[0], device=self.device)
+                    self._share_batches = [tuple(x[idx] for x in selected) for idx in perm.chunk(self.share_reuse)]
+                else:
+                    self._share_batches = [selected]
+            selected = self._share_batches.pop()
+            if self.use_tb and self.share_reuse > 1:
+                metrics['share_batch_age'] = self.share_reuse - len(self._share_batches) - 1
+            return self.merge_share(batch_main, selected)
+        return self.conservative_data_share(batch_main, next(replay_iter_share), replay_iter_share)
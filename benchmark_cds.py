@@ -0,0 +1,63 @@
+import argparse
+import time
+
+import hydra
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+
+def random_batches(batch_size, obs_dim, action_dim):
+    # endless batches shaped like the replay loaders' (CPU tensors), with a fixed pool so sampling costs nothing
+    pool = [tuple(torch.randn(batch_size, dim) for dim in (obs_dim, action_dim, 1, 1, obs_dim)) +
+            (torch.zeros(batch_size, dtype=torch.bool),) for _ in range(4)]
+    while True:
+        yield from pool
+
+
+def sync(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def time_steps(fn, steps, device):
+    for _ in range(10):   # warm up
+        fn()
+    sync(device)
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    sync(device)
+    return (time.time() - start) / steps * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='step time of conservative data sharing with host or device top-k')
+    parser.add_argument('--agent', default='mmd_cds', choices=['mmd_cds', 'c51_cds'])
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', type=int, default=100)
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(f'config/agent/{args.agent}.yaml')
+    cfg.device = args.device
+    cfg.use_tb = False
+    obs_dim, action_dim = cfg.obs_shape, cfg.action_shape
+    main_batch, share_batch = cfg.batch_size // 2, cfg.batch_size // 2 * 10
+    print(f'{args.agent} on {args.device}, batch {main_batch} main + top {main_batch} of {share_batch} share')
+
+    for topk_on_device in [False, True]:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        cfg.topk_on_device = topk_on_device
+        agent = hydra.utils.instantiate(cfg, obs_shape=(obs_dim,), action_shape=(action_dim,))
+        replay_iter_main = random_batches(main_batch, obs_dim, action_dim)
+        replay_iter_share = random_batches(share_batch, obs_dim, action_dim)
+        select_ms = time_steps(lambda: agent.conservative_data_share(next(replay_iter_main), next(replay_iter_share)),
+                               args.steps, args.device)
+        update_ms = time_steps(lambda: agent.update(replay_iter_main, replay_iter_share, 0, args.steps),
+                               args.steps, args.device)
+        print(f"{'device' if topk_on_device else 'host':>6} top-k: selection {select_ms:.2f} ms, update step {update_ms:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Checks the vectorized rewards of custom_dmc_tasks/batch_rewards.py against the per-step get_reward.
+
+For every task, collects the physics states of random rollouts, copies of them with randomly scaled-up velocities (so
+the speed and spin terms leave zero) and perturbed upright poses, and compares make_batch_reward with relabel_rewards, which sets every state
+and calls the task's get_reward.
+
+    python -m checks.batch_rewards
+    python -m checks.batch_rewards --tasks walker_run quadruped_roll
+"""
+import argparse
+
+import numpy as np
+
+import dmc
+from custom_dmc_tasks.batch_rewards import make_batch_reward
+from replay_buffer import relabel_rewards
+
+TASKS = ['walker_stand', 'walker_walk', 'walker_run', 'walker_flip',
+         'cheetah_run', 'cheetah_run_backward', 'cheetah_flip', 'cheetah_flip_backward',
+         'hopper_hop', 'hopper_hop_backward', 'hopper_flip', 'hopper_flip_backward',
+         'quadruped_stand', 'quadruped_walk', 'quadruped_run', 'quadruped_roll', 'quadruped_roll_fast']
+
+
+def collect_states(env, episodes, steps, rng):
+    states = []
+    for _ in range(episodes):
+        env.reset()
+        spec = env.action_spec()
+        for _ in range(steps):
+            env.step(rng.uniform(spec.minimum, spec.maximum, size=spec.shape).astype(spec.dtype))
+            states.append(env.physics.get_state().copy())
+    states = np.array(states)
+    # the same poses moving fast, in both directions
+    nq = env.physics.model.nq
+    fast = states.copy()
+    fast[:, nq:] *= rng.uniform(-20, 20, size=(len(fast), 1))
+    # upright poses near the initial one (random rollouts mostly fall over), with random velocities
+    upright = np.zeros_like(states)
+    upright[:, :nq] = env.physics.model.qpos0 + rng.normal(0, 0.1, size=(len(states), nq))
+    upright[:, nq:] = rng.normal(0, 5, size=(len(states), states.shape[1] - nq))
+    return np.concatenate([states, fast, upright]).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', nargs='+', default=TASKS)
+    parser.add_argument('--episodes', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    failed = []
+    for task in args.tasks:
+        env = dmc.make(task, seed=0)
+        reward_fn = make_batch_reward(env)
+        if reward_fn is None:
+            print(f'{task}: no vectorized reward')
+            failed.append(task)
+            continue
+        states = collect_states(env, args.episodes, args.steps, rng)
+        expected = relabel_rewards(env, states).reshape(len(states))
+        diff = np.abs(np.asarray(reward_fn(states)).reshape(len(states)) - expected).max()
+        print(f'{task}: max diff {diff:.2e} over {len(states)} states, {np.mean(expected > 0):.0%} with a nonzero reward')
+        if not diff <= args.atol:
+            failed.append(task)
+    assert not failed, f'vectorized rewards missing or off for {failed}'
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
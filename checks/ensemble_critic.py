@@ -0,0 +1,47 @@
+"""Checks the stacked ensemble critics of both agents against their twin critics.
+
+A twin critic (separate q1 and q2 networks) is converted with Critic.load_twin_state_dict into a critic with
+ensemble=True. dist() and forward() of both must agree on a random batch, for the MMD and the C51 critic.
+
+    python -m checks.ensemble_critic
+"""
+import argparse
+
+import torch
+
+from agents import c51_cds, mmd_cds
+
+
+def compare(name, twin, ensemble, obs, action, rtol):
+    ensemble.load_twin_state_dict(twin.state_dict())
+    with torch.no_grad():
+        for output, expected, actual in [('dist', twin.dist(obs, action), ensemble.dist(obs, action)),
+                                         ('forward', twin(obs, action), ensemble(obs, action))]:
+            for head, (x, y) in enumerate(zip(expected, actual), start=1):
+                assert x.shape == y.shape, f'{name} {output} q{head}: shape {tuple(y.shape)} vs {tuple(x.shape)}'
+                diff = ((x - y).abs().max() / x.abs().max()).item()
+                print(f'{name} {output} q{head}: relative diff {diff:.1e}')
+                assert diff <= rtol
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--obs_dim', type=int, default=24)
+    parser.add_argument('--action_dim', type=int, default=6)
+    parser.add_argument('--hidden_dim', type=int, default=256)
+    parser.add_argument('--rtol', type=float, default=1e-5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    obs = torch.randn(args.batch_size, args.obs_dim)
+    action = torch.rand(args.batch_size, args.action_dim) * 2 - 1
+    critic_args = (args.obs_dim, args.action_dim, args.hidden_dim)
+    compare('mmd', mmd_cds.Critic(*critic_args), mmd_cds.Critic(*critic_args, ensemble=True), obs, action, args.rtol)
+    compare('c51', c51_cds.Critic(*critic_args, device='cpu'), c51_cds.Critic(*critic_args, device='cpu', ensemble=True),
+            obs, action, args.rtol)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
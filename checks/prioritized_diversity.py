@@ -0,0 +1,83 @@
+"""Checks that prioritized share batches stay diverse while the critic's Q grows.
+
+Feeds PrioritizedReplayBuffer a synthetic Q (a fixed random linear function of the observation, scaled up over
+the steps like a learning critic) and fails if a batch collapses onto few transitions, or if batches no longer
+prefer the dataset's top 10% by Q over uniform sampling. The dataset is synthetic and much larger than
+steps * batch_size, so most transitions are still unscored at the end, as with a full share dataset; pass
+--share to use collected datasets instead.
+
+    python -m checks.prioritized_diversity --steps 1000
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from replay_buffer import PrioritizedReplayBuffer, make_replay_loader
+
+
+class SyntheticBuffer:
+    # the part of OfflineReplayBuffer that PrioritizedReplayBuffer reads: episodes of random transitions
+    _discount = 0.99
+
+    def __init__(self, num_transitions, obs_dim=24, action_dim=6, eps_len=1000):
+        num_episodes = int(np.ceil(num_transitions / eps_len))
+        num_rows = num_episodes * (eps_len + 1)      # +1 for the first dummy transition
+        self._arrays = dict(observation=np.random.randn(num_rows, obs_dim).astype(np.float32),
+                            action=np.random.uniform(-1, 1, (num_rows, action_dim)).astype(np.float32),
+                            reward=np.random.random((num_rows, 1)).astype(np.float32),
+                            discount=np.ones((num_rows, 1), dtype=np.float32))
+        self._eps_start = np.arange(num_episodes, dtype=np.int64) * (eps_len + 1)
+        self._eps_len = np.full(num_episodes, eps_len, dtype=np.int64)
+
+    def compact(self, keys):
+        return ({k: self._arrays[k] for k in keys}, self._eps_start, self._eps_len.copy(),
+                np.zeros(len(self._eps_len), dtype=bool))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--task', default='walker_run')
+    parser.add_argument('--share', nargs='+', default=None, help='e.g. walker_walk-td3-medium')
+    parser.add_argument('--num_transitions', type=int, default=2000000, help='of the synthetic dataset')
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--min_unique', type=float, default=0.5, help='fraction of distinct transitions per batch')
+    parser.add_argument('--min_top', type=float, default=0.15, help='fraction of the batches from the top 10%%')
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    if args.share is None:
+        obs_dim = 24
+        buffer = PrioritizedReplayBuffer(SyntheticBuffer(args.num_transitions, obs_dim), args.batch_size, args.temperature)
+    else:
+        import dmc
+        env = dmc.make(args.task, seed=0)
+        obs_dim = env.observation_spec().shape[0]
+        replay_dirs = [Path('collected_data') / share / 'data' for share in args.share]
+        buffer = make_replay_loader(env, replay_dirs, 10000000, args.batch_size, 1, 0.99, main_task=args.task,
+                                    task_list=[share.split('-')[0] for share in args.share], batched=True,
+                                    prioritized=True, priority_temperature=args.temperature)
+    print(f'{args.steps * args.batch_size / len(buffer._row):.0%} of the dataset drawn over {args.steps} steps')
+    w = np.random.randn(obs_dim)
+    # the dataset's top 10% by the synthetic Q (the scale does not change the ranking)
+    q_all = buffer._arrays['observation'][buffer._row - 1].astype(np.float32) @ w
+    top = q_all >= np.quantile(q_all, 0.9)
+    unique, in_top = [], []
+    for step in range(1, args.steps + 1):
+        batch = buffer.sample()
+        q = batch[0].numpy() @ w * (1 + step / 10)       # std of about 4 at first, growing like a critic's
+        buffer.update_priorities(batch[6], q)
+        unique.append(len(np.unique(batch[6])) / len(batch[6]))
+        in_top.append(top[batch[6]].mean())
+        if step % 100 == 0:
+            print(f'step {step}: {unique[-1]:.1%} distinct in the batch, {in_top[-1]:.1%} from the top 10%, '
+                  f'{buffer.scored_fraction:.1%} of the dataset scored')
+    assert min(unique) >= args.min_unique, f'a batch held only {min(unique):.1%} distinct transitions'
+    assert np.mean(in_top[args.steps // 2:]) > args.min_top, 'batches do not prefer high-Q transitions'
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
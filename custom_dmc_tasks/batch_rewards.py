@@ -0,0 +1,301 @@
+"""Vectorized rewards computed from batches of stored physics states.
+
+The per-step `get_reward` of the tasks reads quantities from a live `Physics`,
+so relabeling has to call `set_state` + `mj_forward` for every stored state.
+The functions here recompute the few quantities the rewards depend on (body
+positions, center-of-mass velocities, ...) with batched kinematics, and
+evaluate the same reward expressions on `(N, physics_dim)` arrays at once.
+"""
+
+import inspect
+
+import numpy as np
+from dm_control.mujoco.wrapper.mjbindings import enums
+from dm_control.utils import rewards
+
+
+def _quat_to_mat(quat):
+    """Converts `(..., 4)` (w, x, y, z) quaternions to `(..., 3, 3)` rotation matrices."""
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(quat, -1, 0)
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], -1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], -1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], -1),
+    ], -2)
+
+
+def _rotate(theta, vec):
+    """Rotates planar (x, z) vectors by `theta` around the y-axis."""
+    cos, sin = np.cos(theta), np.sin(theta)
+    return np.stack([cos * vec[..., 0] + sin * vec[..., 1],
+                     -sin * vec[..., 0] + cos * vec[..., 1]], axis=-1)
+
+
+def _cross_y(omega, vec):
+    """Returns the (x, z) components of `omega * y_hat x vec`."""
+    return np.stack([omega * vec[..., 1], -omega * vec[..., 0]], axis=-1)
+
+
+class PlanarKinematics:
+    """Batched forward kinematics of a model that moves in the x-z plane.
+
+    All hinges must rotate around the (local) y-axis and all body frames may
+    only be rotated around the y-axis, which holds for walker, cheetah and
+    hopper.
+    """
+    def __init__(self, physics):
+        model = physics.model
+        self.nq, self.nv = model.nq, model.nv
+        self.nbody = model.nbody
+        self.parent = model.body_parentid.copy()
+        self.body_pos = model.body_pos[:, [0, 2]].copy()
+        quat = model.body_quat
+        assert np.allclose(quat[:, [1, 3]], 0), 'body frames must rotate around y'
+        self.body_angle = 2 * np.arctan2(quat[:, 2], quat[:, 0])
+        self.body_ipos = model.body_ipos[:, [0, 2]].copy()
+        self.mass = model.body_mass.copy()
+        # inertia around the world y-axis; constant because bodies only rotate around y
+        self.inertia_yy = (_quat_to_mat(model.body_iquat)[:, 1, :] ** 2 *
+                           model.body_inertia).sum(-1)
+
+        self.joints = [[] for _ in range(self.nbody)]
+        for j in range(model.njnt):
+            jnt_type = model.jnt_type[j]
+            axis = model.jnt_axis[j]
+            if jnt_type == enums.mjtJoint.mjJNT_HINGE:
+                assert np.allclose(axis[[0, 2]], 0), 'hinges must rotate around y'
+                axis = np.sign(axis[1])
+            elif jnt_type == enums.mjtJoint.mjJNT_SLIDE:
+                assert np.isclose(axis[1], 0), 'slides must move in the x-z plane'
+                axis = axis[[0, 2]]
+            else:
+                raise ValueError(f'unsupported joint type {jnt_type}')
+            self.joints[model.jnt_bodyid[j]].append(
+                (jnt_type, model.jnt_qposadr[j], model.jnt_dofadr[j], axis,
+                 model.jnt_pos[j, [0, 2]].copy(), model.qpos0[model.jnt_qposadr[j]]))
+
+    def forward(self, states):
+        """Computes the kinematics of a batch of `(qpos, qvel, ...)` states.
+
+        Returns:
+          A dict of `(N, nbody, ...)` arrays: `xpos` and `angle` of the body
+          frames, `xipos` and `vel` of the body centers of mass (x, z) and the
+          angular velocity `omega` around the y-axis.
+        """
+        qpos = states[:, :self.nq].astype(np.float64)
+        qvel = states[:, self.nq:self.nq + self.nv].astype(np.float64)
+        n = states.shape[0]
+        xpos = np.zeros((n, self.nbody, 2))
+        angle = np.zeros((n, self.nbody))
+        origin_vel = np.zeros((n, self.nbody, 2))
+        omega = np.zeros((n, self.nbody))
+        # bodies are stored in topological order, parents always come first
+        for b in range(1, self.nbody):
+            p = self.parent[b]
+            theta = angle[:, p] + self.body_angle[b]
+            pos = xpos[:, p] + _rotate(angle[:, p], self.body_pos[b])
+            motion = []
+            for jnt_type, qadr, dadr, axis, jnt_pos, qpos0 in self.joints[b]:
+                q = qpos[:, qadr] - qpos0
+                if jnt_type == enums.mjtJoint.mjJNT_SLIDE:
+                    slide_axis = _rotate(theta, axis)
+                    pos = pos + slide_axis * q[:, None]
+                    motion.append((jnt_type, slide_axis, qvel[:, dadr]))
+                else:
+                    anchor = pos + _rotate(theta, jnt_pos)
+                    theta = theta + axis * q
+                    pos = anchor - _rotate(theta, jnt_pos)
+                    motion.append((jnt_type, anchor, axis * qvel[:, dadr]))
+            xpos[:, b], angle[:, b] = pos, theta
+            # rigid motion inherited from the parent plus the motion of the own joints
+            vel = origin_vel[:, p] + _cross_y(omega[:, p], pos - xpos[:, p])
+            omega[:, b] = omega[:, p]
+            for jnt_type, vec, dq in motion:
+                if jnt_type == enums.mjtJoint.mjJNT_SLIDE:
+                    vel = vel + vec * dq[:, None]
+                else:
+                    vel = vel + _cross_y(dq, pos - vec)
+                    omega[:, b] += dq
+            origin_vel[:, b] = vel
+        offset = _rotate(angle, self.body_ipos)
+        return dict(xpos=xpos, angle=angle, xipos=xpos + offset,
+                    vel=origin_vel + _cross_y(omega, offset), omega=omega)
+
+    def subtree(self, body_id):
+        """Returns a mask of `body_id` and all of its descendants."""
+        mask = np.zeros(self.nbody, dtype=bool)
+        mask[body_id] = True
+        for b in range(body_id + 1, self.nbody):
+            mask[b] = mask[self.parent[b]]
+        return mask
+
+    def subtree_com_vel(self, kin, body_id):
+        """Returns the (x, z) velocity of the center of mass of a subtree."""
+        mass = self.mass * self.subtree(body_id)
+        return (kin['vel'] * mass[:, None]).sum(1) / mass.sum()
+
+    def subtree_angmom(self, kin, body_id):
+        """Returns the y angular momentum of a subtree around its center of mass."""
+        mass = self.mass * self.subtree(body_id)
+        com = (kin['xipos'] * mass[:, None]).sum(1) / mass.sum()
+        com_vel = (kin['vel'] * mass[:, None]).sum(1) / mass.sum()
+        r = kin['xipos'] - com[:, None]
+        v = kin['vel'] - com_vel[:, None]
+        orbital = r[..., 1] * v[..., 0] - r[..., 0] * v[..., 1]
+        return (mass * orbital + self.inertia_yy * (mass > 0) * kin['omega']).sum(1)
+
+
+def _walker(task, physics, consts):
+    kin = PlanarKinematics(physics)
+    torso = physics.model.name2id('torso', 'body')
+    multitask = type(task).__name__ == 'MultiTaskPlanarWalker'
+    move_speed = getattr(task, '_move_speed', None)
+    flip = getattr(task, '_flip', False)
+
+    def move(speed, velocity):
+        return rewards.tolerance(velocity, bounds=(speed, float('inf')),
+                                 margin=speed / 2, value_at_margin=0.5,
+                                 sigmoid='linear')
+
+    def spin(angmom):
+        return rewards.tolerance(angmom, bounds=(consts._SPIN_SPEED, float('inf')),
+                                 margin=consts._SPIN_SPEED, value_at_margin=0,
+                                 sigmoid='linear')
+
+    def reward_fn(states):
+        k = kin.forward(states)
+        standing = rewards.tolerance(k['xpos'][:, torso, 1],
+                                     bounds=(consts._STAND_HEIGHT, float('inf')),
+                                     margin=consts._STAND_HEIGHT / 2)
+        # the z-z entry of a rotation around y
+        upright = (1 + np.cos(k['angle'][:, torso])) / 2
+        stand_reward = (3 * standing + upright) / 4
+        if multitask:
+            velocity = kin.subtree_com_vel(k, torso)[:, 0]
+            angmom = kin.subtree_angmom(k, torso)
+            return np.stack([
+                stand_reward,
+                stand_reward * (5 * move(consts._WALK_SPEED, velocity) + 1) / 6,
+                stand_reward * (5 * move(consts._RUN_SPEED, velocity) + 1) / 6,
+                stand_reward * (5 * spin(angmom) + 1) / 6], axis=-1)
+        if flip:
+            move_reward = spin(kin.subtree_angmom(k, torso))
+        elif move_speed == 0:
+            return stand_reward
+        else:
+            move_reward = move(move_speed, kin.subtree_com_vel(k, torso)[:, 0])
+        return stand_reward * (5 * move_reward + 1) / 6
+
+    return reward_fn
+
+
+def _cheetah(task, physics, consts):
+    kin = PlanarKinematics(physics)
+    torso = physics.model.name2id('torso', 'body')
+    forward = getattr(task, '_forward', 1)
+    flip = getattr(task, '_flip', False)
+
+    def reward_fn(states):
+        k = kin.forward(states)
+        if flip:
+            return rewards.tolerance(forward * kin.subtree_angmom(k, torso),
+                                     bounds=(consts._SPIN_SPEED, float('inf')),
+                                     margin=consts._SPIN_SPEED,
+                                     value_at_margin=0,
+                                     sigmoid='linear')
+        return rewards.tolerance(forward * kin.subtree_com_vel(k, torso)[:, 0],
+                                 bounds=(consts._RUN_SPEED, float('inf')),
+                                 margin=consts._RUN_SPEED,
+                                 value_at_margin=0,
+                                 sigmoid='linear')
+
+    return reward_fn
+
+
+def _hopper(task, physics, consts):
+    if not task._hopping:
+        return None    # the standing reward depends on the control, which is not part of the state
+    kin = PlanarKinematics(physics)
+    torso = physics.model.name2id('torso', 'body')
+    foot = physics.model.name2id('foot', 'body')
+    forward = getattr(task, '_forward', 1)
+    flip = getattr(task, '_flip', False)
+
+    def reward_fn(states):
+        k = kin.forward(states)
+        height = k['xipos'][:, torso, 1] - k['xipos'][:, foot, 1]
+        standing = rewards.tolerance(height, (consts._STAND_HEIGHT, 2))
+        if flip:
+            hopping = rewards.tolerance(forward * kin.subtree_angmom(k, torso),
+                                        bounds=(consts._SPIN_SPEED, float('inf')),
+                                        margin=consts._SPIN_SPEED,
+                                        value_at_margin=0,
+                                        sigmoid='linear')
+        else:
+            hopping = rewards.tolerance(forward * kin.subtree_com_vel(k, torso)[:, 0],
+                                        bounds=(consts._HOP_SPEED, float('inf')),
+                                        margin=consts._HOP_SPEED / 2,
+                                        value_at_margin=0.5,
+                                        sigmoid='linear')
+        return standing * hopping
+
+    return reward_fn
+
+
+def _quadruped(task, physics, consts):
+    name = type(task).__name__
+    if name not in ('Move', 'Stand', 'Roll'):
+        return None    # the other tasks depend on the full body pose or on the scene
+    model = physics.model
+    torso = model.name2id('torso', 'body')
+    jnt = model.body_jntadr[torso]
+    assert model.jnt_type[jnt] == enums.mjtJoint.mjJNT_FREE
+    qadr, dadr = model.jnt_qposadr[jnt], model.jnt_dofadr[jnt]
+    site = model.sensor_objid[model.name2id('velocimeter', 'sensor')]
+    assert model.site_bodyid[site] == torso
+    site_pos = model.site_pos[site].copy()
+    site_mat = _quat_to_mat(model.site_quat[site])
+    deviation = np.cos(np.deg2rad(0))
+
+    def reward_fn(states):
+        states = states.astype(np.float64)
+        mat = _quat_to_mat(states[:, qadr + 3:qadr + 7])
+        # a free joint stores the linear velocity in the world frame and the angular velocity in the local frame
+        lin_vel = states[:, model.nq + dadr:model.nq + dadr + 3]
+        ang_vel = states[:, model.nq + dadr + 3:model.nq + dadr + 6]
+        local_vel = np.einsum('nji,nj->ni', mat, lin_vel) + np.cross(ang_vel, site_pos)
+        torso_velocity = local_vel @ site_mat
+        upright = rewards.tolerance(mat[:, 2, 2], bounds=(deviation, float('inf')),
+                                    sigmoid='linear', margin=1 + deviation,
+                                    value_at_margin=0)
+        if name == 'Stand':
+            return upright
+        speed = torso_velocity[:, 0] if name == 'Move' else np.linalg.norm(torso_velocity, axis=-1)
+        move_reward = rewards.tolerance(speed, bounds=(task._desired_speed, float('inf')),
+                                        margin=task._desired_speed,
+                                        value_at_margin=0.5,
+                                        sigmoid='linear')
+        return upright * move_reward
+
+    return reward_fn
+
+
+_DOMAINS = dict(walker=_walker, cheetah=_cheetah, hopper=_hopper, quadruped=_quadruped)
+
+
+def make_batch_reward(env):
+    """Returns a vectorized version of the reward of `env`.
+
+    Args:
+      env: A (wrapped) dm_control environment.
+
+    Returns:
+      A function mapping `(N, physics_dim)` states to `(N,)` (or `(N, k)` for
+      multi-task) rewards, or None if the task has no vectorized reward.
+    """
+    task_cls = type(env.task)
+    domain = task_cls.__module__.split('.')[-1]
+    if domain not in _DOMAINS:
+        return None
+    return _DOMAINS[domain](env.task, env.physics, inspect.getmodule(task_cls))
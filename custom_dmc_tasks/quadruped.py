@@ -242,7 +242,7 @@ class Physics(mujoco.Physics):
             sensor_names = self._sensor_types_to_names[sensor_types]
         except KeyError:
             [sensor_ids
-             ] = np.where(np.in1d(self.model.sensor_type, sensor_types))
+             ] = np.where(np.isin(self.model.sensor_type, sensor_types))
             sensor_names = [
                 self.model.id2name(s_id, 'sensor') for s_id in sensor_ids
             ]
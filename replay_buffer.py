@@ -1,142 +1,1391 @@
 import datetime
+import functools
+import hashlib
+import inspect
 import io
+import itertools
+import json
+import multiprocessing
+import os
+import queue
 import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
 import traceback
 import copy
-from collections import defaultdict
+import zipfile
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import IterableDataset
 
+from custom_dmc_tasks.batch_rewards import make_batch_reward
+
 
 def episode_len(episode):
 	# subtract -1 because the dummy first transition
 	return next(iter(episode.values())).shape[0] - 1
 
 
-def save_episode(episode, fn):
-	with io.BytesIO() as bs:
-		np.savez_compressed(bs, **episode)
-		bs.seek(0)
-		with fn.open('wb') as f:
-			f.write(bs.read())
+# every codec writes a plain .npz archive that np.load reads: zlib is what np.savez_compressed writes,
+# fast is deflate at level 1 (much faster to write, slightly larger) and raw is uncompressed, which
+# load_episode can memory-map instead of reading
+EPISODE_CODECS = {'zlib': (zipfile.ZIP_DEFLATED, None), 'fast': (zipfile.ZIP_DEFLATED, 1), 'raw': (zipfile.ZIP_STORED, None)}
+
+
+def save_episode(episode, fn, codec='zlib'):
+	# the arrays are written straight into the archive, one member at a time, without an in-memory copy of the file
+	compression, level = EPISODE_CODECS[codec]
+	with zipfile.ZipFile(fn, 'w', compression=compression, compresslevel=level, allowZip64=True) as zf:
+		for k, v in episode.items():
+			with zf.open(f'{k}.npy', 'w', force_zip64=True) as f:
+				np.lib.format.write_array(f, np.asanyarray(v), allow_pickle=False)
+
+
+def _mmap_episode(fn, mmap_mode):
+	# memory-maps the members of an uncompressed archive, None if any of them is compressed
+	episode = dict()
+	with zipfile.ZipFile(fn) as zf, fn.open('rb') as f:
+		for info in zf.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				return None
+			# the data of a member follows its 30 byte local header, the file name and the extra field
+			f.seek(info.header_offset + 26)
+			name_len, extra_len = struct.unpack('<HH', f.read(4))
+			f.seek(info.header_offset + 30 + name_len + extra_len)
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+			else:
+				shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+			episode[info.filename[:-len('.npy')]] = np.memmap(fn, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+															  shape=shape, order='F' if fortran_order else 'C')
+	return episode
 
 
-def load_episode(fn):
+def load_episode(fn, mmap_mode=None):
+	# mmap_mode ('r' or 'c', see np.load) maps the arrays of raw episodes; compressed episodes are always read
+	if mmap_mode is not None:
+		episode = _mmap_episode(fn, mmap_mode)
+		if episode is not None:
+			return episode
 	with fn.open('rb') as f:
 		episode = np.load(f)
 		episode = {k: episode[k] for k in episode.keys()}
 		return episode
 
 
-def relable_episode(env, episode):   # relabel the reward function
+def load_episodes(fns, num_threads=1, mmap_mode=None):
+	"""Yield load_episode(fn) for every fn in order, decompressing up to num_threads episodes concurrently.
+
+	zlib releases the GIL while inflating, so threads scale without copying arrays between processes.
+	At most 2 * num_threads decompressed episodes wait for the consumer. Prints the throughput at the end.
+	"""
+	num_threads = max(1, num_threads)
+	start, num_episodes, num_bytes = time.time(), 0, 0
+	fns = iter(fns)
+	with ThreadPoolExecutor(num_threads) as executor:
+		pending = deque(executor.submit(load_episode, fn, mmap_mode) for fn in itertools.islice(fns, 2 * num_threads))
+		while pending:
+			episode = pending.popleft().result()
+			pending.extend(executor.submit(load_episode, fn, mmap_mode) for fn in itertools.islice(fns, 1))
+			num_episodes += 1
+			num_bytes += sum(v.nbytes for v in episode.values())
+			yield episode
+	seconds = max(time.time() - start, 1e-6)
+	print(f"loaded {num_episodes} episodes ({num_bytes / 2 ** 20:.0f} MB) in {seconds:.2f}s with {num_threads} threads: "
+		  f"{num_episodes / seconds:.0f} episodes/s, {num_bytes / 2 ** 20 / seconds:.0f} MB/s")
+
+
+def convert_codec(replay_dir, codec, num_threads=1):
+	"""Rewrite every episode of replay_dir with the given codec.
+
+	Each episode is written next to the original and renamed over it, so an interrupted conversion leaves
+	every file a complete episode in either codec. A manifest of the directory is rebuilt, since file sizes
+	and checksums change; relabel caches only depend on the contents and stay valid, columnar stores see the
+	changed sizes and are converted again when next loaded.
+	"""
+	eps_fns = sorted(replay_dir.glob('*.npz'))
+	# the generator goes first: zip stops at the first exhausted iterable, so it runs to its end and reports
+	for episode, eps_fn in zip(load_episodes(eps_fns, num_threads), eps_fns):
+		tmp_fn = eps_fn.with_name(eps_fn.name + '.tmp')
+		save_episode(episode, tmp_fn, codec)
+		tmp_fn.replace(eps_fn)
+	print(f'converted {len(eps_fns)} episodes of {replay_dir} to {codec}')
+	if manifest_path(replay_dir).exists():
+		build_manifest(replay_dir)
+
+
+def relabel_rewards(env, states):
+	# Input: the stored physics states of an episode, then use env.task.get_reward to calculate the reward
 	rewards = []
 	reward_spec = env.reward_spec()
-	states = episode['physics']
 	for i in range(states.shape[0]):
 		with env.physics.reset_context():
 			env.physics.set_state(states[i])
-		# Input: the current physics of env, then use env.task.get_reward to calculate the reward
 		reward = env.task.get_reward(env.physics)
 		reward = np.full(reward_spec.shape, reward, reward_spec.dtype)  # 改变shape和dtype
 		rewards.append(reward)
+	return np.array(rewards, dtype=reward_spec.dtype)
+
+
+def relable_episode(env, episode):   # relabel the reward function
 	original_reward = np.mean(episode['reward'])
-	episode['reward'] = np.array(rewards, dtype=reward_spec.dtype)
+	episode['reward'] = relabel_rewards(env, episode['physics'])
 	# print("Reward difference after relabeling:", original_reward - episode['reward'].mean())
 	return episode
 
 
+def relabel_check_rows(offsets, eps, num_states=256):
+	# rows of num_states random transitions spread over the episodes eps of a ColumnarStore layout
+	eps = np.asarray(eps)[np.random.randint(0, len(eps), size=num_states)]
+	return offsets[eps] + np.random.randint(0, offsets[eps + 1] - offsets[eps])
+
+
+def make_batch_relabel(env, check_states):
+	# vectorized relabeling, only used if it agrees with the MuJoCo rewards on every one of check_states
+	reward_fn = make_batch_reward(env)
+	if reward_fn is None:
+		return None
+	reward_spec = env.reward_spec()
+
+	def relabel(states):
+		rewards = np.asarray(reward_fn(states), dtype=reward_spec.dtype)
+		return rewards.reshape((states.shape[0],) + reward_spec.shape)
+
+	if not np.allclose(relabel(check_states), relabel_rewards(env, check_states), atol=1e-5):
+		print("vectorized reward does not match the MuJoCo reward, fall back to per-step relabeling")
+		return None
+	return relabel
+
+
+# every relabel worker process owns its own environment of the main task
+_relabel_env = None
+
+
+def _init_relabel_worker(task):
+	global _relabel_env
+	import dmc
+	_relabel_env = dmc.make(task)
+
+
+def _relabel_worker(states):
+	return relabel_rewards(_relabel_env, states)
+
+
+def reward_fn_version(env, vectorized=False):
+	# the reward of a task is defined in the module of its task class, so any edit there changes the version.
+	# vectorized rewards are computed by custom_dmc_tasks/batch_rewards.py instead, which is part of their version
+	key = hashlib.sha1()
+	with open(inspect.getfile(type(env.task)), 'rb') as f:
+		key.update(f.read())
+	if vectorized:
+		with open(inspect.getfile(make_batch_reward), 'rb') as f:
+			key.update(b'vectorized' + f.read())
+	return key.hexdigest()[:12]
+
+
+class RelabelCache:
+	# sidecar cache of relabeled reward columns, one .npy per episode.
+	# the key is the content hash of the episode's physics states (the only input of the reward) and
+	# the reward function version; the cache dir is per main task. a changed episode or task is a cache miss.
+	# if the cache dir cannot be written (read-only or network-mounted datasets) nothing is stored
+	def __init__(self, cache_dir, env, vectorized=False):
+		self._cache_dir = cache_dir
+		self._version = reward_fn_version(env, vectorized)
+		self._writable = True
+		try:
+			self._cache_dir.mkdir(parents=True, exist_ok=True)
+		except OSError as e:
+			self._not_writable(e)
+		self.hits = 0
+		self.misses = 0
+
+	def _not_writable(self, e):
+		print(f'could not write the relabel cache {self._cache_dir} ({e}), relabeled rewards are not cached')
+		self._writable = False
+
+	def _path(self, states):
+		key = hashlib.sha1(np.ascontiguousarray(states).tobytes())
+		key.update(self._version.encode())
+		return self._cache_dir / f'{key.hexdigest()}.npy'
+
+	def load(self, states):
+		path = self._path(states)
+		if not path.exists():
+			self.misses += 1
+			return None
+		self.hits += 1
+		return np.load(path)
+
+	def save(self, states, reward):
+		if not self._writable:
+			return
+		path = self._path(states)
+		# a temporary file of its own per writer: concurrent runs may miss the same key at once
+		try:
+			fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, prefix=f'{path.stem}.{os.getpid()}.', suffix='.tmp')
+		except OSError as e:
+			self._not_writable(e)
+			return
+		with os.fdopen(fd, 'wb') as f:
+			np.save(f, reward)
+		os.replace(tmp_path, path)     # atomic, concurrent runs never read a partial file
+
+
+def episode_fn_info(eps_fn):
+	# file names look like episode_<idx>_<len>.npz
+	eps_idx, eps_len = [int(x) for x in eps_fn.stem.split('_')[1:]]
+	return eps_idx, eps_len
+
+
+def manifest_path(replay_dir):
+	return replay_dir.parent / 'manifest.json'
+
+
+def build_manifest(replay_dir):
+	"""Describe every episode of replay_dir in one json file next to it.
+
+	Each entry holds the file name, episode id and length, the row offset of the episode in the
+	concatenated (columnar) layout, the file size in bytes, the episode return and a crc32 of the file.
+	The mtime of replay_dir is recorded too, load_manifest compares it to tell whether files were added,
+	removed or replaced since. If the dataset directory is not writable the manifest is only returned.
+	"""
+	# taken before the listing, so files added while it runs make the manifest look out of date
+	mtime = os.stat(replay_dir).st_mtime_ns
+	episodes, offset = [], 0
+	for eps_fn in sorted(replay_dir.glob('*.npz')):
+		eps_idx, eps_len = episode_fn_info(eps_fn)
+		data = eps_fn.read_bytes()
+		with np.load(io.BytesIO(data)) as episode:
+			reward = episode['reward']
+		episodes.append(dict(file=eps_fn.name, id=eps_idx, length=eps_len, offset=offset, nbytes=len(data),
+							 ret=float(reward[1:].sum()), crc32=zlib.crc32(data)))
+		offset += eps_len + 1     # +1 for the first dummy transition
+	manifest = dict(num_rows=offset, mtime=mtime, episodes=episodes)
+	if _write_manifest(replay_dir, manifest):
+		print(f'wrote manifest of {len(episodes)} episodes to {manifest_path(replay_dir)}')
+	return manifest
+
+
+def _write_manifest(replay_dir, manifest):
+	# returns whether the manifest could be written
+	path = manifest_path(replay_dir)
+	tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')     # loader workers may build it concurrently
+	try:
+		with tmp_path.open('w') as f:
+			json.dump(manifest, f)
+		tmp_path.rename(path)
+	except OSError as e:
+		print(f'could not write the manifest of {replay_dir} ({e}), using it for this run only')
+		return False
+	return True
+
+
+def episode_sizes(replay_dir):
+	# file name -> size in bytes of every episode of replay_dir, from one listing of the directory
+	return {e.name: e.stat().st_size for e in os.scandir(replay_dir) if e.name.endswith('.npz')}
+
+
+def load_manifest(replay_dir):
+	path = manifest_path(replay_dir)
+	if not path.exists():
+		return build_manifest(replay_dir)
+	with path.open() as f:
+		manifest = json.load(f)
+	# adding, removing or renaming a file updates the mtime of the directory, so one stat tells whether the
+	# manifest can be trusted (a file rewritten in place under the same name is not noticed, convert_codec
+	# replaces files through a rename). only when it differs the directory is listed with the size of every file;
+	# no episode is read, and crc32 is not checked, that would read the whole dataset
+	mtime = os.stat(replay_dir).st_mtime_ns
+	if manifest.get('mtime') == mtime:
+		return manifest
+	files = episode_sizes(replay_dir)
+	recorded = {e['file']: e['nbytes'] for e in manifest['episodes']}
+	if files != recorded:
+		added, removed = len(files.keys() - recorded.keys()), len(recorded.keys() - files.keys())
+		changed = sum(files[k] != recorded[k] for k in files.keys() & recorded.keys())
+		print(f'manifest of {replay_dir} is out of date ({added} added, {removed} removed, {changed} changed), rebuilding')
+		return build_manifest(replay_dir)
+	# same episodes (e.g. a temporary file came and went): record the new mtime, so the next run only stats again
+	manifest['mtime'] = mtime
+	_write_manifest(replay_dir, manifest)
+	return manifest
+
+
+def list_episodes(replay_dir, use_manifest=False):
+	# (file name, episode id, episode length) of every episode in replay_dir, sorted by file name.
+	# with use_manifest the episodes are planned from the manifest, checked against the mtime of the directory
+	if use_manifest:
+		return [(e['file'], e['id'], e['length']) for e in load_manifest(replay_dir)['episodes']]
+	return [(eps_fn.name,) + episode_fn_info(eps_fn) for eps_fn in sorted(replay_dir.glob('*.npz'))]
+
+
+def nstep_returns(arrays, offsets, nstep, discount):
+	"""n-step rewards and discounts of every row of episodes laid out as in a ColumnarStore.
+
+	The transition at row t accumulates r_t + discount * d_t * r_{t+1} + ... over k = min(nstep, steps left in its
+	episode) steps. The returned discount column is discount^(k - 1) * d_t * ... * d_{t+k-1}, so samplers multiply by
+	discount once, as for 1-step transitions, and next_offset = k - 1 is the row of the bootstrap observation
+	relative to t. The loop runs over the horizon, every step is vectorized over all rows.
+	"""
+	num_rows = len(arrays['reward'])
+	rows = np.arange(num_rows)
+	end = np.repeat(offsets[1:] - 1, np.diff(offsets))     # last row of the episode of every row
+	reward = np.zeros_like(arrays['reward'])
+	scale = np.ones_like(arrays['discount'])                # discount^i * d_t * ... * d_{t+i-1}
+	next_offset = np.full(num_rows, -1, dtype=np.int16)
+	for i in range(nstep):
+		valid = rows + i <= end
+		r = np.minimum(rows + i, num_rows - 1)
+		reward += np.where(valid[:, None], scale * arrays['reward'][r], 0)
+		scale = np.where(valid[:, None], scale * discount * arrays['discount'][r], scale)
+		next_offset += valid
+	return reward, (scale / discount).astype(arrays['discount'].dtype), next_offset
+
+
+def _next_rows(arrays, row):
+	# rows of the next (bootstrap) observations of the transitions at row, further than 1 step with nstep > 1
+	return row + arrays['next_offset'][row] if 'next_offset' in arrays else row
+
+
+def compact_dtype(x, dtype):
+	# float16 is a numpy dtype; numpy has no bfloat16, so those values are kept as their upper 16 bits in uint16
+	if dtype == 'float16':
+		return np.asarray(x, dtype=np.float16)
+	assert dtype == 'bfloat16', dtype
+	bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+	return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)     # round to nearest even
+
+
+def to_float32(x):
+	# inverse of compact_dtype, applied to sampled rows only
+	x = np.asarray(x)
+	if x.dtype == np.uint16:
+		return (x.astype(np.uint32) << 16).view(np.float32)
+	return x.astype(np.float32, copy=False)
+
+
+def spill_array(x):
+	# moves x into a memory-mapped temporary file, unlinked at once so nothing is left behind.
+	# its pages can then be written back to disk instead of taking process memory
+	with tempfile.NamedTemporaryFile(suffix='.npy') as f:
+		spilled = np.lib.format.open_memmap(f.name, mode='w+', dtype=x.dtype, shape=x.shape)
+		spilled[:] = x
+		spilled.flush()
+	return spilled
+
+
+class ColumnarStore:
+	# all episodes of a data directory concatenated into flat, contiguous arrays.
+	# episode i occupies rows offsets[i]:offsets[i + 1] (including its dummy first transition)
+	def __init__(self, arrays, offsets, ids):
+		self.arrays = arrays
+		self.offsets = offsets
+		self.ids = ids
+
+	def __len__(self):
+		return len(self.ids)
+
+	def episode_len(self, i):
+		return int(self.offsets[i + 1] - self.offsets[i]) - 1
+
+	def episode(self, i):
+		start, end = self.offsets[i], self.offsets[i + 1]
+		return {k: v[start:end] for k, v in self.arrays.items()}
+
+	def nbytes(self):
+		# (bytes in process memory, bytes memory-mapped from files)
+		resident = sum(v.nbytes for v in self.arrays.values() if not isinstance(v, np.memmap))
+		mapped = sum(v.nbytes for v in self.arrays.values() if isinstance(v, np.memmap))
+		return resident, mapped
+
+	@classmethod
+	def from_files(cls, replay_dir, plan, num_threads=1):
+		# read the planned (file name, episode id, episode length) episodes into exact-size arrays,
+		# allocated once the first episode tells the keys, dtypes and shapes
+		offsets = np.concatenate([[0], np.cumsum([eps_len + 1 for _, _, eps_len in plan])]).astype(np.int64)
+		arrays = dict()
+		episodes = load_episodes([replay_dir / eps_name for eps_name, _, _ in plan], num_threads, mmap_mode='r')
+		# the generator goes first: zip stops at the first exhausted iterable, so it runs to its end and reports
+		for i, (episode, (eps_name, _, eps_len)) in enumerate(zip(episodes, plan)):
+			assert episode_len(episode) == eps_len, f'{eps_name} has {episode_len(episode)} steps'
+			for k, v in episode.items():
+				if k not in arrays:
+					arrays[k] = np.empty((int(offsets[-1]),) + v.shape[1:], dtype=v.dtype)
+				arrays[k][offsets[i]:offsets[i + 1]] = v
+		ids = np.array([eps_idx for _, eps_idx, _ in plan], dtype=np.int64)
+		return cls(arrays, offsets, ids)
+
+	@classmethod
+	def load(cls, store_dir, mmap_mode='c'):
+		# np.load(mmap_mode=...) returns np.memmap views, so opening is near-instant and
+		# every process reading the same files shares the OS page cache.
+		# copy-on-write ('c') keeps the views writable (torch warns on read-only arrays) without touching the files
+		offsets = np.load(store_dir / 'offsets.npy')
+		ids = np.load(store_dir / 'ids.npy')
+		arrays = {fn.stem: np.load(fn, mmap_mode=mmap_mode) for fn in sorted(store_dir.glob('*.npy'))
+				  if fn.stem not in ('offsets', 'ids')}
+		return cls(arrays, offsets, ids)
+
+
+def convert_episodes(replay_dir, store_dir, use_manifest=False, num_threads=1):
+	"""Rewrite the .npz episodes of replay_dir into a ColumnarStore directory.
+
+	The store records the mtime of replay_dir and the size of every episode file in source.json, which
+	store_is_current checks. An existing (out-of-date) store_dir is replaced.
+	"""
+	# taken before the episodes are listed, so files added meanwhile make the store look out of date
+	source = dict(mtime=os.stat(replay_dir).st_mtime_ns, files=episode_sizes(replay_dir))
+	infos = list_episodes(replay_dir, use_manifest)
+	assert len(infos) > 0, f'no episodes found in {replay_dir}'
+	# add +1 for the first dummy transition
+	offsets = np.concatenate([[0], np.cumsum([eps_len + 1 for _, _, eps_len in infos])]).astype(np.int64)
+	ids = np.array([eps_idx for _, eps_idx, _ in infos], dtype=np.int64)
+
+	# write into a temporary directory of this process and rename at the end, so an interrupted conversion is never
+	# picked up and runs converting the same dataset at once do not write into each other's files
+	store_dir.parent.mkdir(parents=True, exist_ok=True)
+	tmp_dir = Path(tempfile.mkdtemp(dir=store_dir.parent, prefix=f'{store_dir.name}.{os.getpid()}.', suffix='.tmp'))
+	arrays = dict()
+	for i, episode in enumerate(load_episodes([replay_dir / eps_name for eps_name, _, _ in infos], num_threads, mmap_mode='r')):
+		for k, v in episode.items():
+			if k not in arrays:    # preallocate exact-size output files
+				arrays[k] = np.lib.format.open_memmap(tmp_dir / f'{k}.npy', mode='w+', dtype=v.dtype,
+													  shape=(int(offsets[-1]),) + v.shape[1:])
+			arrays[k][offsets[i]:offsets[i + 1]] = v
+	for v in arrays.values():
+		v.flush()
+	del arrays
+	np.save(tmp_dir / 'offsets.npy', offsets)
+	np.save(tmp_dir / 'ids.npy', ids)
+	with (tmp_dir / 'source.json').open('w') as f:
+		json.dump(source, f)
+	stale_dir = None
+	if _store_source(store_dir).get('files') == source['files']:
+		# another run converted the same dataset again meanwhile
+		shutil.rmtree(tmp_dir)
+		print(f'{store_dir} was converted by another run')
+		return
+	if store_dir.exists():
+		# move the out-of-date store aside first; runs that mapped its files keep reading them until they exit
+		stale_dir = store_dir.with_name(f'{tmp_dir.name}.stale')
+		try:
+			store_dir.rename(stale_dir)
+		except OSError:
+			stale_dir = None     # another run moved it first
+	try:
+		tmp_dir.rename(store_dir)
+	except OSError:
+		if not store_dir.is_dir():
+			raise
+		# another run converted the same dataset first, its store holds the same episodes
+		shutil.rmtree(tmp_dir)
+		print(f'{store_dir} was converted by another run')
+		return
+	finally:
+		if stale_dir is not None:
+			shutil.rmtree(stale_dir)
+	print(f'converted {len(infos)} episodes of {replay_dir} into {store_dir}')
+
+
+def _store_source(store_dir):
+	# the source listing recorded by convert_episodes, empty if there is no store or it was written before stores recorded one
+	try:
+		with (store_dir / 'source.json').open() as f:
+			return json.load(f)
+	except OSError:
+		return dict()
+
+
+def store_is_current(replay_dir, store_dir):
+	# whether the ColumnarStore in store_dir still holds the episodes of replay_dir, checked as in load_manifest:
+	# one stat of replay_dir, and only if its mtime changed a listing of the file names and sizes
+	source = _store_source(store_dir)
+	if not source:
+		print(f'{store_dir} records no source listing')
+		return False
+	mtime = os.stat(replay_dir).st_mtime_ns
+	if source['mtime'] == mtime:
+		return True
+	files = episode_sizes(replay_dir)
+	if files != source['files']:
+		added, removed = len(files.keys() - source['files'].keys()), len(source['files'].keys() - files.keys())
+		changed = sum(files[k] != source['files'][k] for k in files.keys() & source['files'].keys())
+		print(f'{store_dir} is out of date ({added} added, {removed} removed, {changed} changed)')
+		return False
+	# same episodes: record the new mtime, so the next run only stats again
+	source['mtime'] = mtime
+	tmp_path = store_dir / f'source.json.{os.getpid()}.tmp'
+	try:
+		with tmp_path.open('w') as f:
+			json.dump(source, f)
+		tmp_path.rename(store_dir / 'source.json')
+	except OSError:
+		pass     # a read-only store is only listed again next time
+	return True
+
+
+def _transition_rows(eps_start, eps_len):
+	# episode and row of every transition of the episodes starting at eps_start (rows of a compact() layout)
+	eps = np.repeat(np.arange(len(eps_len)), eps_len)
+	# add +1 for the first dummy transition
+	row = eps_start[eps] + np.arange(len(eps)) - np.repeat(np.cumsum(eps_len) - eps_len, eps_len) + 1
+	return eps, row
+
+
+def _unique_rows(x):
+	# index of the first occurrence of every distinct row of x (compared bytewise) and the row -> unique row map
+	x = np.ascontiguousarray(x).reshape(len(x), -1)
+	rows = x.view(np.dtype((np.void, x.dtype.itemsize * x.shape[1]))).ravel()
+	_, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+	return first, inverse.ravel()
+
+
+def _row_bytes(x):
+	return np.ascontiguousarray(x).reshape(len(x), -1).view(np.uint8)
+
+
+class TransitionTable:
+	# the transitions of all episodes of a buffer with exact duplicates stored once.
+	# every distinct observation is kept once and transitions refer to it by id; a transition is a duplicate when its
+	# observation, action, reward, discount, next observation and task all match. Each unique transition is drawn with the
+	# summed probability the episode sampler gives its copies (1 / (num episodes * episode length) each), so the
+	# distribution of sampled transitions is unchanged
+	def __init__(self, arrays, eps_start, eps_len, eps_main):
+		eps, row = _transition_rows(eps_start, eps_len)
+		obs_first, obs_id = _unique_rows(arrays['observation'])
+		next_row = _next_rows(arrays, row)
+		key = np.concatenate([_row_bytes(obs_id[row - 1]), _row_bytes(obs_id[next_row]), _row_bytes(arrays['action'][row]),
+							  _row_bytes(arrays['reward'][row]), _row_bytes(arrays['discount'][row]),
+							  _row_bytes(eps_main[eps])], axis=1)
+		first, inverse = _unique_rows(key)
+		obs_id = obs_id.astype(np.int32 if len(obs_first) < 2 ** 31 else np.int64)
+		self.count = np.bincount(inverse).astype(np.int32)         # multiplicity of every unique transition
+		weight = np.bincount(inverse, weights=1.0 / (len(eps_len) * eps_len[eps]))
+		self._cdf = np.cumsum(weight)
+		self.observation = arrays['observation'][obs_first]
+		self.obs_id = obs_id[row[first] - 1]
+		self.next_obs_id = obs_id[next_row[first]]
+		self.action = arrays['action'][row[first]]
+		self.reward = arrays['reward'][row[first]]
+		self.discount = arrays['discount'][row[first]]
+		self.main = eps_main[eps[first]]
+		print(f"dedup: {len(row)} transitions -> {len(first)} unique, {len(eps_start) + len(row)} observations -> "
+			  f"{len(obs_first)} unique, {self.nbytes() / 2 ** 20:.0f} MB")
+
+	def __len__(self):
+		return len(self.count)
+
+	def nbytes(self):
+		return sum(x.nbytes for x in (self.observation, self.obs_id, self.next_obs_id, self.action, self.reward,
+									  self.discount, self.main, self.count, self._cdf))
+
+	def sample(self, batch_size):
+		k = np.searchsorted(self._cdf, np.random.random(batch_size) * self._cdf[-1], side='right')
+		k = np.minimum(k, len(self._cdf) - 1)
+		return (self.observation[self.obs_id[k]], self.action[k], self.reward[k], self.discount[k],
+				self.observation[self.next_obs_id[k]], self.main[k])
+
+
 class OfflineReplayBuffer(IterableDataset):
 	# 用于 offline training 的 dataset
-	def __init__(self, env, replay_dir_list, max_size, num_workers, discount, main_task, task_list):
+	def __init__(self, env, replay_dir_list, max_size, num_workers, discount, main_task, task_list, data_format='npz',
+				 batch_size=None, relabel_cache=False, relabel_workers=1, relabel_vectorized=False,
+				 use_manifest=False, load_threads=1, storage_dtype='float32', physics='keep', dedup=False, nstep=1):
 		self._env = env
 		self._replay_dir_list = replay_dir_list
 		self._size = 0
 		self._max_size = max_size
 		self._num_workers = max(1, num_workers)
-		self._episode_fns = []
-		self._episodes = dict()    # save as episode
+		self._stores = []          # one ColumnarStore per replay dir
+		self._store_main = []      # whether the store belongs to the main task
 		self._discount = discount
 		self._loaded = False
 		self._main_task = main_task
 		self._task_list = task_list
+		self._data_format = data_format
+		assert data_format in ['npz', 'columnar']
+		self._batch_size = batch_size    # if set, iterate over whole batches instead of single transitions
+		self._relabel_cache = relabel_cache
+		self._relabel_workers = relabel_workers
+		self._relabel_vectorized = relabel_vectorized
+		self._use_manifest = use_manifest    # plan loading from manifest.json instead of listing the directory
+		self._load_threads = load_threads    # episodes decompressed concurrently
+		self._storage_dtype = storage_dtype  # float32, float16 or bfloat16 for observations and actions
+		self._physics = physics              # keep, drop or spill the physics states once relabeled
+		assert storage_dtype in ['float32', 'float16', 'bfloat16'] and physics in ['keep', 'drop', 'spill']
+		# columnar stores are mapped from the shared page cache, converting them would copy them into process memory
+		assert storage_dtype == 'float32' or data_format == 'npz', 'replay_buffer_dtype needs replay_buffer_format=npz'
+		self._dedup = dedup                  # sample from a TransitionTable without duplicated transitions
+		self._table = None
+		self._nstep = nstep                  # >1: rewards, discounts and next observations span nstep steps
 
 	def _load(self, relable=True):
 		print("load data", self._replay_dir_list, self._task_list)
+		try:
+			worker_id = torch.utils.data.get_worker_info().id
+		except:
+			worker_id = 0
+		eps_store, eps_start, eps_len = [], [], []
 		for i in range(len(self._replay_dir_list)):       # loop
 			_replay_dir = self._replay_dir_list[i]
 			_task_share = self._task_list[i]
 			assert _task_share in str(_replay_dir)
-			try:
-				worker_id = torch.utils.data.get_worker_info().id
-			except:
-				worker_id = 0
 			print(f'Loading data from {_replay_dir} and Relabel...', "worker_id:", worker_id)      # each worker will run this function
 			print(f"Need relabeling: {relable and _task_share != self._main_task}")
-			eps_fns = sorted(_replay_dir.glob('*.npz'))
-			for eps_fn in eps_fns:
-				if self._size > self._max_size:
-					break
-				eps_idx, eps_len = [int(x) for x in eps_fn.stem.split('_')[1:]]
-				if eps_idx % self._num_workers != worker_id:  # read the npz file of the worker
-					continue
-				# load a npz file to represent an episodic sample. The keys include 'observation', 'action', 'reward', 'discount', 'physics'
-				episode = load_episode(eps_fn)
-
-				if relable and _task_share != self._main_task:
-					# print(f"relabel {_replay_dir} for {self._main_task} task")
-					episode = self._relable_reward(episode)   # relabel
-				data_flag = _task_share+str(eps_fn)+str(_task_share == self._main_task)
-				self._episode_fns.append(data_flag)
-				self._episodes[data_flag] = episode
-				self._size += episode_len(episode)
-				# if worker_id == 0:
-				# 	print("data_flag:", data_flag)
-		print("load done. Num of episodes", len(self._episode_fns)*self._num_workers)
-
-	def _sample_episode(self):
+			if self._data_format == 'columnar':
+				store, eps = self._load_columnar(_replay_dir, worker_id)
+			else:
+				store, eps = self._load_npz(_replay_dir, worker_id)
+			if len(eps) == 0:
+				continue
+			if relable and _task_share != self._main_task:
+				# print(f"relabel {_replay_dir} for {self._main_task} task")
+				cache_dir = _replay_dir.parent / 'relabel' / self._main_task if self._relabel_cache else None
+				self._relable_store(store, eps, cache_dir)     # relabel
+			self._compact_store(store)
+			if self._nstep > 1:
+				# after relabeling, so the n-step rewards are those of the main task
+				reward, discount, next_offset = nstep_returns(store.arrays, store.offsets, self._nstep, self._discount)
+				store.arrays.update(reward=reward, discount=discount, next_offset=next_offset)
+			resident, mapped = store.nbytes()
+			print(f"{_replay_dir}: {resident / 2 ** 20:.0f} MB in memory, {mapped / 2 ** 20:.0f} MB mapped "
+				  f"({', '.join(f'{k}: {v.dtype}' for k, v in store.arrays.items())})")
+			eps_store += [len(self._stores)] * len(eps)
+			eps_start += [store.offsets[j] for j in eps]
+			eps_len += [store.episode_len(j) for j in eps]
+			self._stores.append(store)
+			self._store_main.append(_task_share == self._main_task)
+		# flat episode table over all stores, used for sampling
+		self._eps_store = np.array(eps_store, dtype=np.int64)
+		self._eps_start = np.array(eps_start, dtype=np.int64)
+		self._eps_len = np.array(eps_len, dtype=np.int64)
+		print("load done. Num of episodes", len(self._eps_len)*self._num_workers)
+
+	def _load_npz(self, replay_dir, worker_id):
+		# plan which episodes this worker reads before reading any, then load them into preallocated arrays
+		plan = []
+		for eps_name, eps_idx, eps_len in list_episodes(replay_dir, self._use_manifest):
+			if self._size > self._max_size:
+				break
+			if eps_idx % self._num_workers != worker_id:  # read the npz file of the worker
+				continue
+			plan.append((eps_name, eps_idx, eps_len))
+			self._size += eps_len
+		if len(plan) == 0:
+			return None, []
+		# each npz file represents an episodic sample. The keys include 'observation', 'action', 'reward', 'discount', 'physics'
+		return ColumnarStore.from_files(replay_dir, plan, self._load_threads), list(range(len(plan)))
+
+	def _load_columnar(self, replay_dir, worker_id):
+		store_dir = replay_dir.parent / 'columnar'
+		if not store_dir.exists() or not store_is_current(replay_dir, store_dir):
+			convert_episodes(replay_dir, store_dir, self._use_manifest, self._load_threads)
+		store = ColumnarStore.load(store_dir)
+		eps = []
+		for j in range(len(store)):
+			if self._size > self._max_size:
+				break
+			if store.ids[j] % self._num_workers != worker_id:
+				continue
+			eps.append(j)
+			self._size += store.episode_len(j)
+		return store, eps
+
+	def _compact_store(self, store):
+		# after relabeling nothing reads the physics states any more
+		if self._physics == 'drop':
+			store.arrays.pop('physics', None)
+		elif self._physics == 'spill' and not isinstance(store.arrays.get('physics'), (np.memmap, type(None))):
+			store.arrays['physics'] = spill_array(store.arrays['physics'])
+		if self._storage_dtype != 'float32':
+			for k in ('observation', 'action'):
+				store.arrays[k] = compact_dtype(store.arrays[k], self._storage_dtype)
+
+	def _relable_store(self, store, eps, cache_dir=None):
+		# the relabeled reward column lives in memory, never in the (shared) memory-mapped file.
+		# the relabel path is chosen first, cached rewards are only reused from the same path
+		batch_relabel = None
+		if self._relabel_vectorized and len(eps) > 0:
+			rows = np.sort(relabel_check_rows(store.offsets, eps))
+			batch_relabel = make_batch_relabel(self._env, np.asarray(store.arrays['physics'][rows]))
+		cache = RelabelCache(cache_dir, self._env, batch_relabel is not None) if cache_dir is not None else None
+		reward = np.array(store.arrays['reward'])
+		todo = []
+		for j in eps:
+			eps_reward = cache.load(store.episode(j)['physics']) if cache is not None else None
+			if eps_reward is None:
+				todo.append(j)
+			else:
+				reward[store.offsets[j]:store.offsets[j + 1]] = eps_reward
+		for j, eps_reward in zip(todo, self._relabel_rewards(store, todo, batch_relabel)):
+			reward[store.offsets[j]:store.offsets[j + 1]] = eps_reward
+			if cache is not None:
+				cache.save(store.episode(j)['physics'], eps_reward)
+		store.arrays['reward'] = reward
+		if cache is not None:
+			print(f"relabel cache: {cache.hits} hits, {cache.misses} misses")
+
+	def _relabel_rewards(self, store, eps, batch_relabel=None):
+		# yields the relabeled reward column of each episode in eps, in order
+		if batch_relabel is not None:
+			for j in eps:
+				yield batch_relabel(np.asarray(store.episode(j)['physics']))
+			return
+		if self._relabel_workers <= 1 or len(eps) <= 1:
+			for j in eps:
+				yield self._relable_reward(store.episode(j))['reward']
+			return
+		num_workers = min(self._relabel_workers, len(eps))
+		print(f"relabel {len(eps)} episodes with {num_workers} processes")
+		# spawn instead of fork: the loading process already runs MuJoCo and torch threads
+		ctx = multiprocessing.get_context('spawn')
+		with ctx.Pool(num_workers, initializer=_init_relabel_worker, initargs=(self._main_task,)) as pool:
+			states = (np.asarray(store.episode(j)['physics']) for j in eps)
+			yield from pool.imap(_relabel_worker, states)
+
+	def _relable_reward(self, episode):
+		return relable_episode(self._env, episode)
+
+	def _ensure_loaded(self):
 		if not self._loaded:
 			self._load()
 			self._loaded = True
-		eps_fn = random.choice(self._episode_fns)
-		return self._episodes[eps_fn], eps_fn.endswith("True")   # whether is the main buffer
+			if self._dedup:
+				self._table = TransitionTable(*self.compact(['observation', 'action', 'reward', 'discount']))
+				self._stores = []     # the table holds everything sampling needs
 
-	def _relable_reward(self, episode):
-		return relable_episode(self._env, episode)
+	def compact(self, keys):
+		# copies the sampled episodes of all stores into one flat array per key.
+		# returns the arrays, the start row and length of every episode and whether it belongs to the main task
+		self._ensure_loaded()
+		assert self._table is None, 'a deduplicated buffer has no episodes'
+		if self._nstep > 1:
+			keys = list(keys) + ['next_offset']
+		arrays = {k: np.concatenate([self._stores[s].arrays[k][b:b + n + 1] for s, b, n in
+									 zip(self._eps_store, self._eps_start, self._eps_len)]) for k in keys}
+		# add +1 for the first dummy transition
+		eps_start = np.concatenate([[0], np.cumsum(self._eps_len + 1)[:-1]]).astype(np.int64)
+		eps_main = np.array(self._store_main)[self._eps_store]
+		return arrays, eps_start, self._eps_len.copy(), eps_main
 
 	def _sample(self):
-		episode, eps_flag = self._sample_episode()   # return the signal
+		self._ensure_loaded()
+		if self._table is not None:
+			obs, action, reward, discount, next_obs, main = self._table.sample(1)
+			return (to_float32(obs[0]), to_float32(action[0]), reward[0], discount[0] * self._discount,
+					to_float32(next_obs[0]), bool(main[0]))
+		i = random.randrange(len(self._eps_len))
+		store_id = self._eps_store[i]
+		arrays = self._stores[store_id].arrays
 		# add +1 for the first dummy transition
-		idx = np.random.randint(0, episode_len(episode)) + 1
-		obs = episode['observation'][idx - 1]
-		action = episode['action'][idx]
-		next_obs = episode['observation'][idx]
-		reward = episode['reward'][idx]
-		discount = episode['discount'][idx] * self._discount
+		idx = self._eps_start[i] + np.random.randint(0, self._eps_len[i]) + 1
+		obs = to_float32(arrays['observation'][idx - 1])
+		action = to_float32(arrays['action'][idx])
+		next_obs = to_float32(arrays['observation'][_next_rows(arrays, idx)])
+		reward = arrays['reward'][idx]
+		discount = arrays['discount'][idx] * self._discount
+
+		return (obs, action, reward, discount, next_obs, bool(self._store_main[store_id]))    # whether is the main buffer
 
-		return (obs, action, reward, discount, next_obs, bool(eps_flag))
+	def _sample_batch(self, batch_size):
+		self._ensure_loaded()
+		if self._table is not None:
+			obs, action, reward, discount, next_obs, main = self._table.sample(batch_size)
+			return tuple(torch.from_numpy(to_float32(x)) for x in (obs, action, reward, discount * self._discount, next_obs)) \
+				+ (torch.from_numpy(main),)
+		# draw the episodes and steps of the whole batch at once
+		eps = np.random.randint(0, len(self._eps_len), size=batch_size)
+		# add +1 for the first dummy transition
+		idx = self._eps_start[eps] + np.random.randint(0, self._eps_len[eps]) + 1
+		store_ids = self._eps_store[eps]
+		parts = []
+		for store_id in np.unique(store_ids):
+			arrays = self._stores[store_id].arrays
+			j = idx[store_ids == store_id]
+			parts.append((arrays['observation'][j - 1], arrays['action'][j], arrays['reward'][j],
+						  arrays['discount'][j] * self._discount, arrays['observation'][_next_rows(arrays, j)],
+						  np.full(len(j), self._store_main[store_id])))
+		# the order inside a batch does not matter, so the stores are simply stacked one after another
+		batch = parts[0] if len(parts) == 1 else [np.concatenate(xs) for xs in zip(*parts)]
+		obs, action, reward, discount, next_obs, eps_flag = batch
+		return tuple(torch.from_numpy(to_float32(x)) for x in (obs, action, reward, discount, next_obs)) \
+			+ (torch.from_numpy(eps_flag),)
 
 	def __iter__(self):
 		while True:
-			yield self._sample()
+			if self._batch_size is None:
+				yield self._sample()
+			else:
+				yield self._sample_batch(self._batch_size)
 
 	def __getitem__(self, index):
 		return self._sample()
 
 
+class StreamingReplayBuffer(OfflineReplayBuffer):
+	# keeps at most stream_size transitions resident instead of truncating the datasets at max_size.
+	# a background thread loads episodes into a queue of swaps episodes, and each batch swaps in at most swaps of them,
+	# so the resident set turns over gradually and the loader waits instead of competing with the trainer.
+	# 'lru': the loader draws episodes uniformly from all datasets and each replaces the least recently sampled
+	# resident episode. 'reservoir': the loader goes through the episodes in shuffled passes and keeps the t-th
+	# episode of a pass with probability num_slots / t in a random slot (the first num_slots of a pass fill the slots
+	# in order), so at any time the resident episodes are a uniform sample of the dataset. rejected episodes are not read
+	_KEYS = ('observation', 'action', 'reward', 'discount', 'next_offset')
+
+	def __init__(self, *args, stream_size, eviction='lru', swaps=1, **kwargs):
+		super().__init__(*args, **kwargs)
+		assert self._data_format == 'npz', 'columnar stores are memory-mapped already, only npz datasets are streamed'
+		assert not self._dedup, 'streamed episodes are not deduplicated'
+		assert eviction in ['lru', 'reservoir'] and swaps >= 1
+		self._stream_size = stream_size
+		self._eviction = eviction
+		self._swaps = swaps
+
+	def _load(self, relable=True):
+		print("stream data", self._replay_dir_list, self._task_list)
+		try:
+			worker_id = torch.utils.data.get_worker_info().id
+		except:
+			worker_id = 0
+		# every episode of this worker, over all datasets: (replay dir index, file name, episode length)
+		self._plan = []
+		for i, replay_dir in enumerate(self._replay_dir_list):
+			assert self._task_list[i] in str(replay_dir)
+			for eps_name, eps_idx, eps_len in list_episodes(replay_dir, self._use_manifest):
+				if eps_idx % self._num_workers == worker_id:
+					self._plan.append((i, eps_name, eps_len))
+		assert len(self._plan) > 0, f'no episodes found in {self._replay_dir_list}'
+		self._relabelers = [self._make_relabeler(i) if relable and task != self._main_task else None
+							for i, task in enumerate(self._task_list)]
+
+		# one fixed-size slot per resident episode, so swapping an episode never reallocates
+		max_len = max(eps_len for _, _, eps_len in self._plan)
+		num_slots = max(1, min(len(self._plan), self._stream_size // max_len))
+		order = np.random.permutation(len(self._plan))[:num_slots]
+		first = self._read(order[0])
+		self._arrays = {k: np.empty((num_slots, max_len + 1) + first[k].shape[1:], dtype=first[k].dtype) for k in self._KEYS}
+		self._slot_len = np.zeros(num_slots, dtype=np.int64)
+		self._slot_main = np.zeros(num_slots, dtype=bool)
+		self._last_used = np.zeros(num_slots, dtype=np.int64)
+		self._num_batches = 0
+		self._put(0, first)
+		for slot, p in enumerate(order[1:], start=1):
+			self._put(slot, self._read(p))
+		self._size = int(self._slot_len.sum())
+		print(f"{sum(v.nbytes for v in self._arrays.values()) / 2 ** 20:.0f} MB in memory "
+			  f"({', '.join(f'{k}: {v.dtype}' for k, v in self._arrays.items())})")
+
+		# (episode, slot) pairs, slot None for lru. bounded, so the loader blocks once swaps episodes are ready
+		self._ready = queue.Queue(maxsize=self._swaps)
+		self._stream_error = None
+		if num_slots == len(self._plan):
+			print(f"all {num_slots} episodes are resident, nothing to stream")
+			return
+		# the initial residents are the first num_slots episodes of the first reservoir pass
+		first_pass = np.concatenate([order, np.setdiff1d(np.arange(len(self._plan)), order)])
+		threading.Thread(target=self._stream, args=(first_pass,), daemon=True).start()
+		print(f"streaming {len(self._plan)} episodes through {num_slots} resident slots, eviction: {self._eviction}, "
+			  f"at most {self._swaps} swapped in per batch")
+
+	def _make_relabeler(self, i):
+		# also runs in the loader thread, so it gets its own environment of the main task instead of self._env
+		import dmc
+		replay_dir = self._replay_dir_list[i]
+		if not hasattr(self, '_relabel_env'):
+			self._relabel_env = dmc.make(self._main_task)
+		relabel = None
+		if self._relabel_vectorized:
+			# random states of a few random episodes of the dataset
+			eps_names = [eps_name for j, eps_name, _ in self._plan if j == i]
+			states = [load_episode(replay_dir / eps_names[k])['physics']
+					  for k in np.random.choice(len(eps_names), min(8, len(eps_names)), replace=False)]
+			offsets = np.concatenate([[0], np.cumsum([len(x) for x in states])])
+			states = np.concatenate(states)[relabel_check_rows(offsets, np.arange(len(states)))]
+			relabel = make_batch_relabel(self._relabel_env, states)
+		cache = None
+		if self._relabel_cache:
+			cache = RelabelCache(replay_dir.parent / 'relabel' / self._main_task, self._relabel_env, relabel is not None)
+		if relabel is None:
+			relabel = functools.partial(relabel_rewards, self._relabel_env)
+
+		def relabeler(states):
+			reward = cache.load(states) if cache is not None else None
+			if reward is None:
+				reward = relabel(states)
+				if cache is not None:
+					cache.save(states, reward)
+			return reward
+		return relabeler
+
+	def _read(self, p):
+		i, eps_name, eps_len = self._plan[p]
+		episode = load_episode(self._replay_dir_list[i] / eps_name, mmap_mode='r')
+		assert episode_len(episode) == eps_len, f'{eps_name} has {episode_len(episode)} steps'
+		if self._relabelers[i] is not None:
+			episode['reward'] = self._relabelers[i](episode['physics'])
+		episode['main'] = self._task_list[i] == self._main_task
+		offsets = np.array([0, eps_len + 1])
+		if self._nstep > 1:
+			episode['reward'], episode['discount'], episode['next_offset'] = \
+				nstep_returns(episode, offsets, self._nstep, self._discount)
+		else:
+			episode['next_offset'] = np.zeros(eps_len + 1, dtype=np.int16)
+		if self._storage_dtype != 'float32':
+			for k in ('observation', 'action'):
+				episode[k] = compact_dtype(episode[k], self._storage_dtype)
+		return episode
+
+	def _put(self, slot, episode):
+		n = episode_len(episode) + 1
+		for k in self._KEYS:
+			self._arrays[k][slot, :n] = episode[k]
+		self._slot_len[slot] = n - 1
+		self._slot_main[slot] = episode['main']
+		self._last_used[slot] = self._num_batches     # a fresh episode counts as used, or lru would evict it first
+
+	def _stream(self, first_pass):
+		# has its own random generator, the sampling thread uses the global one
+		rng = np.random.default_rng(np.random.randint(2 ** 31))
+		num_slots = len(self._slot_len)
+		try:
+			if self._eviction == 'lru':
+				while True:
+					self._ready.put((self._read(rng.integers(len(self._plan))), None))
+			order, t = first_pass, num_slots     # the initial residents took the first num_slots places
+			while True:
+				for p in order[t:]:
+					t += 1
+					if t <= num_slots:
+						slot = t - 1
+					elif rng.random() < num_slots / t:
+						slot = int(rng.integers(num_slots))
+					else:
+						continue
+					self._ready.put((self._read(p), slot))
+				order, t = rng.permutation(len(self._plan)), 0
+		except:
+			self._stream_error = traceback.format_exc()
+
+	def _refresh(self):
+		# swap in at most swaps of the loaded episodes; only the sampling thread writes the slots
+		if self._stream_error is not None:
+			raise RuntimeError(f'episode streaming failed:\n{self._stream_error}')
+		for _ in range(self._swaps):
+			try:
+				episode, slot = self._ready.get_nowait()
+			except queue.Empty:
+				return
+			if slot is None:
+				slot = int(np.argmin(self._last_used))
+			self._put(slot, episode)
+
+	def compact(self, keys):
+		# make_replay_loader asserts that no consumer of compact() is combined with streaming
+		raise TypeError('a streaming buffer has no complete copy of the dataset to compact')
+
+	def _sample(self):
+		self._ensure_loaded()
+		obs, action, reward, discount, next_obs, main = self._sample_slots(1)
+		return obs[0], action[0], reward[0], discount[0], next_obs[0], bool(main[0])
+
+	def _sample_batch(self, batch_size):
+		self._ensure_loaded()
+		batch = self._sample_slots(batch_size)
+		return tuple(torch.from_numpy(np.asarray(x, dtype=np.float32)) for x in batch[:5]) + (torch.from_numpy(batch[5]),)
+
+	def _sample_slots(self, batch_size):
+		self._refresh()
+		self._num_batches += 1
+		slots = np.random.randint(0, len(self._slot_len), size=batch_size)
+		self._last_used[slots] = self._num_batches
+		# add +1 for the first dummy transition
+		step = np.random.randint(0, self._slot_len[slots]) + 1
+		arrays = self._arrays
+		return (to_float32(arrays['observation'][slots, step - 1]), to_float32(arrays['action'][slots, step]),
+				arrays['reward'][slots, step], arrays['discount'][slots, step] * self._discount,
+				to_float32(arrays['observation'][slots, step + arrays['next_offset'][slots, step]]), self._slot_main[slots])
+
+
+def _device_tensor(x, device):
+	# bfloat16 values are stored as uint16 bits on the host (see compact_dtype)
+	if x.dtype == np.uint16:
+		return torch.from_numpy(x.view(np.int16)).to(device).view(torch.bfloat16)
+	return torch.as_tensor(x, device=device)
+
+
+class DeviceReplayBuffer:
+	# the whole dataset of an OfflineReplayBuffer, uploaded once to the training device.
+	# batches are drawn there with torch.randint + index_select, without DataLoader, collation or host-to-device copies
+	def __init__(self, buffer, batch_size, device):
+		arrays, eps_start, eps_len, eps_main = buffer.compact(['observation', 'action', 'reward', 'discount'])
+		# observations and actions keep their storage dtype on the device and are upcast after the gather
+		self._observation = _device_tensor(arrays['observation'], device)
+		self._action = _device_tensor(arrays['action'], device)
+		self._reward = torch.as_tensor(arrays['reward'], dtype=torch.float32, device=device)
+		self._discount = torch.as_tensor(arrays['discount'] * buffer._discount, dtype=torch.float32, device=device)
+		self._eps_start = torch.as_tensor(eps_start, device=device)
+		self._eps_len = torch.as_tensor(eps_len, device=device)
+		self._eps_main = torch.as_tensor(eps_main, device=device)
+		self._next_offset = torch.as_tensor(arrays['next_offset'], device=device).long() if 'next_offset' in arrays else None
+		self._batch_size = batch_size
+		self._device = device
+		print(f"uploaded {len(eps_len)} episodes to {device}")
+
+	def sample(self):
+		eps = torch.randint(len(self._eps_len), (self._batch_size,), device=self._device)
+		eps_len = self._eps_len[eps]
+		step = (torch.rand(self._batch_size, device=self._device) * eps_len).long()
+		# add +1 for the first dummy transition
+		idx = self._eps_start[eps] + torch.minimum(step, eps_len - 1) + 1
+		next_idx = idx if self._next_offset is None else idx + self._next_offset.index_select(0, idx)
+		return (self._observation.index_select(0, idx - 1).float(), self._action.index_select(0, idx).float(),
+				self._reward.index_select(0, idx), self._discount.index_select(0, idx),
+				self._observation.index_select(0, next_idx).float(), self._eps_main[eps])
+
+	def __iter__(self):
+		while True:
+			yield self.sample()
+
+
+class SumTree:
+	# priorities of capacity leaves in a flat binary tree: node i has children 2i and 2i + 1, the root is node 1
+	# and the leaves start at self._size. updates and searches handle whole batches, one numpy op per tree level
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self._size = 1 << int(np.ceil(np.log2(max(2, capacity))))
+		self._tree = np.zeros(2 * self._size)
+
+	@property
+	def total(self):
+		return self._tree[1]
+
+	def leaves(self):
+		return self._tree[self._size:self._size + self.capacity]
+
+	def build(self, priorities):
+		self._tree[self._size:self._size + self.capacity] = priorities
+		level = self._size
+		while level > 1:
+			level //= 2
+			self._tree[level:2 * level] = self._tree[2 * level:4 * level:2] + self._tree[2 * level + 1:4 * level:2]
+
+	def update(self, idx, priorities):
+		# for repeated indices the last priority wins; parents are recomputed from their children
+		node = np.asarray(idx) + self._size
+		self._tree[node] = priorities
+		node = np.unique(node // 2)
+		while node[0] >= 1:
+			self._tree[node] = self._tree[2 * node] + self._tree[2 * node + 1]
+			node = np.unique(node // 2)
+
+	def sample(self, batch_size):
+		# stratified: one uniform draw from each of batch_size equal slices of the total priority
+		u = (np.arange(batch_size) + np.random.random(batch_size)) * (self.total / batch_size)
+		node = np.ones(batch_size, dtype=np.int64)
+		while node[0] < self._size:
+			left = 2 * node
+			go_right = u >= self._tree[left]
+			u = u - self._tree[left] * go_right
+			node = left + go_right
+		# rounding can step into the zero-priority padding after the last leaf
+		return np.minimum(node - self._size, self.capacity - 1)
+
+
+class PrioritizedReplayBuffer:
+	# the share transitions of an OfflineReplayBuffer drawn in proportion to exp(z / temperature), z the critic's Q
+	# standardized by running statistics and clipped to [-z_clip, z_clip], instead of drawing ten times the batch
+	# uniformly and keeping the top Q. standardizing keeps the preference independent of the growing scale of the
+	# critic and the clip bounds the ratio between priorities, so batches stay diverse. the agent reports the Q of
+	# every sampled transition through update_priorities. transitions that were never scored, or not re-scored for
+	# stale_after updates (by default one pass of batches over the dataset), sit at the neutral priority exp(0) of
+	# the mean Q: high-Q transitions are preferred over them, and they are still drawn more often than low-Q ones
+	def __init__(self, buffer, batch_size, temperature, stale_after=None, z_clip=3.0):
+		assert stale_after is None or stale_after >= 1, 'share_priority_stale_after must be null or at least 1'
+		arrays, eps_start, eps_len, eps_main = buffer.compact(['observation', 'action', 'reward', 'discount'])
+		eps, self._row = _transition_rows(eps_start, eps_len)
+		self._main = eps_main[eps]
+		self._arrays = arrays
+		self._arrays['discount'] = arrays['discount'] * buffer._discount
+		self._batch_size = batch_size
+		self._temperature = temperature
+		self._stale_after = stale_after if stale_after is not None else int(np.ceil(len(self._row) / batch_size))
+		self._z_clip = z_clip
+		self._q_mean, self._q_var = None, None      # running statistics of the reported Q
+		self._updates = 0
+		self._scored_at = np.zeros(len(self._row), dtype=np.int64)     # update that last scored each leaf, 0: never
+		self._history = deque()                     # (update, idx) of the scored batches, oldest first
+		self._tree = SumTree(len(self._row))
+		self._tree.build(np.ones(len(self._row)))
+		print(f"prioritized sampling over {len(self._row)} transitions, scores stale after {self._stale_after} updates")
+
+	@property
+	def scored_fraction(self):
+		return np.count_nonzero(self._scored_at) / len(self._scored_at)
+
+	def sample(self):
+		idx = self._tree.sample(self._batch_size)
+		row = self._row[idx]
+		arrays = self._arrays
+		return tuple(torch.from_numpy(to_float32(x)) for x in (arrays['observation'][row - 1], arrays['action'][row],
+															   arrays['reward'][row], arrays['discount'][row],
+															   arrays['observation'][_next_rows(arrays, row)])) \
+			+ (torch.from_numpy(self._main[idx]), idx)
+
+	def update_priorities(self, idx, q):
+		idx = np.asarray(idx)
+		q = np.asarray(q, dtype=np.float64).reshape(-1)
+		if self._q_mean is None:
+			self._q_mean, self._q_var = q.mean(), q.var()
+		else:
+			# follows the critic's scale over about a hundred updates
+			self._q_mean += 0.01 * (q.mean() - self._q_mean)
+			self._q_var += 0.01 * (q.var() + (q.mean() - self._q_mean) ** 2 - self._q_var)
+		z = np.clip((q - self._q_mean) / np.sqrt(self._q_var + 1e-8), -self._z_clip, self._z_clip)
+		self._updates += 1
+		self._scored_at[idx] = self._updates
+		self._history.append((self._updates, idx))
+		# leaves last scored stale_after updates ago go back to the neutral priority
+		stale = []
+		while self._history and self._history[0][0] <= self._updates - self._stale_after:
+			update, old_idx = self._history.popleft()
+			stale.append(old_idx[self._scored_at[old_idx] == update])
+		if stale:
+			stale = np.concatenate(stale)
+			self._scored_at[stale] = 0
+			idx = np.concatenate([stale, idx])
+			z = np.concatenate([np.zeros(len(stale)), z])
+		self._tree.update(idx, np.exp(z / self._temperature))
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return self.sample()
+
+
+class ScoredReplayBuffer:
+	# the share transitions of an OfflineReplayBuffer with a cached conservative score each.
+	# every interval steps refresh() re-scores the whole dataset in chunks of chunk_size, and batches are drawn
+	# uniformly from the transitions scoring at least the top_fraction quantile, so the agent scores nothing per step.
+	# before the first refresh all transitions are candidates
+	def __init__(self, buffer, batch_size, interval, chunk_size, top_fraction):
+		arrays, eps_start, eps_len, eps_main = buffer.compact(['observation', 'action', 'reward', 'discount'])
+		eps, self._row = _transition_rows(eps_start, eps_len)
+		self._main = eps_main[eps]
+		self._arrays = arrays
+		self._arrays['discount'] = arrays['discount'] * buffer._discount
+		self._batch_size = batch_size
+		self._interval = interval
+		self._chunk_size = chunk_size
+		self._top_fraction = top_fraction
+		self.scores = np.zeros(len(self._row), dtype=np.float32)
+		self.threshold = None
+		self._selected = np.arange(len(self._row))
+		self._scored_step = None
+		print(f"cached scores over {len(self._row)} transitions, refreshed every {interval} steps")
+
+	def refresh(self, step, score_fn):
+		# score_fn maps a chunk of observations and actions (numpy) to one score per transition (numpy).
+		# returns whether the scores were refreshed
+		if self._scored_step is not None and step - self._scored_step < self._interval:
+			return False
+		for start in range(0, len(self._row), self._chunk_size):
+			row = self._row[start:start + self._chunk_size]
+			self.scores[start:start + len(row)] = score_fn(to_float32(self._arrays['observation'][row - 1]),
+														   to_float32(self._arrays['action'][row]))
+		k = max(1, int(np.ceil(self._top_fraction * len(self.scores))))
+		self.threshold = np.partition(self.scores, len(self.scores) - k)[len(self.scores) - k]
+		self._selected = np.flatnonzero(self.scores >= self.threshold)
+		self._scored_step = step
+		return True
+
+	def sample(self):
+		idx = self._selected[np.random.randint(0, len(self._selected), size=self._batch_size)]
+		row = self._row[idx]
+		arrays = self._arrays
+		return tuple(torch.from_numpy(to_float32(x)) for x in (arrays['observation'][row - 1], arrays['action'][row],
+															   arrays['reward'][row], arrays['discount'][row],
+															   arrays['observation'][_next_rows(arrays, row)])) \
+			+ (torch.from_numpy(self._main[idx]),)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return self.sample()
+
+
+_BATCH_KEYS = ('observation', 'action', 'reward', 'discount', 'next_observation', 'main')
+
+
+def _produce_batches(data, slots, free_slots, full_slots, batch_size, seed):
+	# sampler process: fills free slots of the shared ring buffer with ready-collated batches
+	np.random.seed(seed)
+	data = {k: v.numpy() for k, v in data.items()}
+	slots = {k: v.numpy() for k, v in slots.items()}
+	eps_start, eps_len, eps_main = data['eps_start'], data['eps_len'], data['eps_main']
+	while True:
+		slot = free_slots.get()
+		if slot is None:
+			return
+		eps = np.random.randint(0, len(eps_len), size=batch_size)
+		# add +1 for the first dummy transition
+		idx = eps_start[eps] + np.random.randint(0, eps_len[eps]) + 1
+		# gather straight into shared memory, no intermediate arrays
+		np.take(data['observation'], idx - 1, axis=0, out=slots['observation'][slot])
+		np.take(data['action'], idx, axis=0, out=slots['action'][slot])
+		np.take(data['reward'], idx, axis=0, out=slots['reward'][slot])
+		np.take(data['discount'], idx, axis=0, out=slots['discount'][slot])
+		next_idx = idx + data['next_offset'][idx] if 'next_offset' in data else idx
+		np.take(data['observation'], next_idx, axis=0, out=slots['next_observation'][slot])
+		np.take(eps_main, eps, out=slots['main'][slot])
+		full_slots.put(slot)
+
+
+class SharedBatchProducer:
+	# num_workers sampler processes attach once to the dataset of an OfflineReplayBuffer (moved to shared memory)
+	# and write collated batches into a ring of num_slots shared-memory slots, overlapping sampling with the update.
+	# the trainer gets views of a slot, which stay valid until the next batch is requested. with a cuda
+	# pin_memory_device it gets device tensors instead, copied asynchronously through pinned memory
+	def __init__(self, buffer, batch_size, num_workers, num_slots, pin_memory_device=None):
+		arrays, eps_start, eps_len, eps_main = buffer.compact(['observation', 'action', 'reward', 'discount'])
+		arrays['discount'] = arrays['discount'] * buffer._discount
+		next_offset = arrays.pop('next_offset', None)
+		data = {k: torch.from_numpy(to_float32(v)).share_memory_() for k, v in arrays.items()}
+		if next_offset is not None:
+			data['next_offset'] = torch.from_numpy(next_offset.astype(np.int64)).share_memory_()
+		data['eps_start'] = torch.from_numpy(eps_start).share_memory_()
+		data['eps_len'] = torch.from_numpy(eps_len).share_memory_()
+		data['eps_main'] = torch.from_numpy(eps_main).share_memory_()
+
+		shapes = dict(observation=arrays['observation'].shape[1:], action=arrays['action'].shape[1:],
+					  reward=arrays['reward'].shape[1:], discount=arrays['discount'].shape[1:],
+					  next_observation=arrays['observation'].shape[1:], main=())
+		self._slots = {k: torch.empty((num_slots, batch_size) + tuple(shape),
+									  dtype=torch.bool if k == 'main' else torch.float32).share_memory_()
+					   for k, shape in shapes.items()}
+		self._pinned = None
+		if pin_memory_device is not None and torch.device(pin_memory_device).type == 'cuda':
+			self._device = torch.device(pin_memory_device)
+			# two staging buffers: one is filled while the copy out of the other may still be running
+			self._pinned = [{k: torch.empty_like(v[0]).pin_memory() for k, v in self._slots.items()} for _ in range(2)]
+			self._copied = [None, None]     # cuda event recorded after the copy out of each staging buffer
+			self._next_pinned = 0
+
+		# spawn instead of fork: the trainer already runs torch (and possibly CUDA) threads
+		ctx = torch.multiprocessing.get_context('spawn')
+		self._free_slots = ctx.SimpleQueue()
+		self._full_slots = ctx.Queue()      # waited on with a timeout, to notice workers that died
+		for slot in range(num_slots):
+			self._free_slots.put(slot)
+		self._held_slot = None
+		seed = np.random.randint(0, 2 ** 31 - num_workers)
+		self._workers = [ctx.Process(target=_produce_batches, daemon=True,
+									 args=(data, self._slots, self._free_slots, self._full_slots, batch_size, seed + i))
+						 for i in range(num_workers)]
+		for worker in self._workers:
+			worker.start()
+		print(f"started {num_workers} batch producers with {num_slots} slots")
+
+	def sample(self):
+		if self._held_slot is not None:
+			self._free_slots.put(self._held_slot)
+			self._held_slot = None
+		while True:
+			try:
+				slot = self._full_slots.get(timeout=1)
+				break
+			except queue.Empty:
+				for worker in self._workers:
+					if not worker.is_alive():
+						raise RuntimeError(f'batch producer {worker.pid} exited with code {worker.exitcode}')
+		if self._pinned is not None:
+			# copy into pinned memory, hand the slot back at once and start the host-to-device copy without waiting
+			i = self._next_pinned
+			self._next_pinned = 1 - i
+			if self._copied[i] is not None:
+				self._copied[i].synchronize()     # the copy started two batches ago still reads this buffer
+			pinned = self._pinned[i]
+			for k in _BATCH_KEYS:
+				pinned[k].copy_(self._slots[k][slot])
+			self._free_slots.put(slot)
+			batch = tuple(pinned[k].to(self._device, non_blocking=True) for k in _BATCH_KEYS)
+			self._copied[i] = torch.cuda.Event()
+			self._copied[i].record(torch.cuda.current_stream(self._device))
+			return batch
+		self._held_slot = slot
+		return tuple(self._slots[k][slot] for k in _BATCH_KEYS)
+
+	def __iter__(self):
+		while True:
+			yield self.sample()
+
+	def close(self):
+		for _ in self._workers:
+			self._free_slots.put(None)
+		for worker in self._workers:
+			worker.join(timeout=5)
+			if worker.is_alive():
+				worker.terminate()      # still starting up, or stuck
+
+
 def _worker_init_fn(worker_id):
 	seed = np.random.get_state()[1][0] + worker_id
 	np.random.seed(seed)
 	random.seed(seed)
 
 
-def make_replay_loader(env, replay_dir_list, max_size, batch_size, num_workers, discount, main_task, task_list):
-	max_size_per_worker = max_size // max(1, num_workers)
+def make_replay_loader(env, replay_dir_list, max_size, batch_size, num_workers, discount, main_task, task_list,
+					   data_format='npz', batched=False, relabel_cache=False, relabel_workers=1,
+					   relabel_vectorized=False, device=None, producer=False, num_slots=4, pin_memory_device=None,
+					   use_manifest=False, stream_size=None, stream_eviction='lru', stream_swaps=1, load_threads=1,
+					   storage_dtype='float32', physics='keep', dedup=False, prioritized=False, priority_temperature=1.0,
+					   priority_stale_after=None, score_interval=None, score_chunk=65536, top_fraction=0.1, nstep=1):
+	# the device buffer, producers, dedup and the prioritized and scored buffers share one dataset loaded by the trainer,
+	# so it must not be split across workers
+	shard_workers = 1 if device is not None or producer or dedup or prioritized or score_interval is not None else num_workers
+	max_size_per_worker = max_size // max(1, shard_workers)
 
-	iterable = OfflineReplayBuffer(env, replay_dir_list, max_size_per_worker,
-								   num_workers, discount, main_task, task_list)      # task 表示主任务
+	args = (env, replay_dir_list, max_size_per_worker, shard_workers, discount, main_task, task_list, data_format,
+			batch_size if batched else None, relabel_cache, relabel_workers, relabel_vectorized, use_manifest,
+			load_threads, storage_dtype, physics, dedup, nstep)
+	if dedup:
+		# the device buffer and the batch producers sample episodes, which a deduplicated buffer no longer has
+		assert device is None and not producer, 'dedup needs replay_buffer_on_device=False and replay_buffer_producer=False'
+	if stream_size is not None:
+		# the device buffer and the batch producers copy the whole dataset, which a streaming buffer never holds
+		assert device is None and not producer, 'streaming needs replay_buffer_on_device=False and replay_buffer_producer=False'
+		iterable = StreamingReplayBuffer(*args, stream_size=stream_size // max(1, shard_workers), eviction=stream_eviction,
+										 swaps=stream_swaps)
+	else:
+		iterable = OfflineReplayBuffer(*args)      # task 表示主任务
+	if score_interval is not None:
+		# scores live in this process, next to the agent that refreshes them
+		assert device is None and not producer and not dedup and stream_size is None and not prioritized, \
+			'cached scores replace the device buffer, batch producers, dedup, streaming and prioritized sampling'
+		return ScoredReplayBuffer(iterable, batch_size, score_interval, score_chunk, top_fraction)
+	if prioritized:
+		# priorities live in this process, next to the agent that updates them
+		assert device is None and not producer and not dedup and stream_size is None, \
+			'prioritized sampling replaces the device buffer, batch producers, dedup and streaming'
+		return PrioritizedReplayBuffer(iterable, batch_size, priority_temperature, priority_stale_after)
+	if device is not None:
+		return DeviceReplayBuffer(iterable, batch_size, device)
+	if producer:
+		return SharedBatchProducer(iterable, batch_size, max(1, num_workers), num_slots, pin_memory_device)
+	if batched:
+		# the buffer already yields collated batches, skip the per-sample collation of the DataLoader
+		return torch.utils.data.DataLoader(iterable, batch_size=None)
 
 	# loader = torch.utils.data.DataLoader(iterable,
 	# 									 batch_size=batch_size,
@@ -147,3 +1396,13 @@ def make_replay_loader(env, replay_dir_list, max_size, batch_size, num_workers,
 										 batch_size=batch_size)
 	return loader
 
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='rewrite the episodes of data directories with another codec')
+	parser.add_argument('codec', choices=list(EPISODE_CODECS))
+	parser.add_argument('replay_dirs', nargs='+', type=Path, help='e.g. collected_data/walker_run-td3-medium/data')
+	parser.add_argument('--num_threads', type=int, default=4)
+	args = parser.parse_args()
+	for replay_dir in args.replay_dirs:
+		convert_codec(replay_dir, args.codec, args.num_threads)
@@ -106,13 +106,38 @@ def main(cfg: DictConfig):
     print("CDS.  load main dataset..", cfg.task)
     replay_loader_main = make_replay_loader(env, replay_dir_list_main, cfg.replay_buffer_size,
                 cfg.batch_size // 2, cfg.replay_buffer_num_workers, cfg.discount,      # batch size (half)
-                main_task=cfg.task, task_list=[cfg.task])
+                main_task=cfg.task, task_list=[cfg.task], data_format=cfg.replay_buffer_format,
+                batched=cfg.replay_buffer_batched, relabel_cache=cfg.relabel_cache,
+                relabel_workers=cfg.relabel_workers, relabel_vectorized=cfg.relabel_vectorized,
+                device=cfg.device if cfg.replay_buffer_on_device else None,
+                producer=cfg.replay_buffer_producer, num_slots=cfg.replay_buffer_num_slots,
+                pin_memory_device=cfg.device if cfg.replay_buffer_pin_memory else None,
+                use_manifest=cfg.replay_buffer_manifest, stream_size=cfg.replay_buffer_stream_size,
+                stream_eviction=cfg.replay_buffer_stream_eviction, stream_swaps=cfg.replay_buffer_stream_swaps,
+                load_threads=cfg.replay_buffer_load_threads,
+                storage_dtype=cfg.replay_buffer_dtype, physics=cfg.replay_buffer_physics,
+                dedup=cfg.replay_buffer_dedup, nstep=cfg.agent.nstep)
     replay_iter_main = iter(replay_loader_main)      # run OfflineReplayBuffer.sample function
 
     print("CDS.  load share dataset..", share_tasks)
     replay_loader_share = make_replay_loader(env, replay_dir_list_share, cfg.replay_buffer_size,
-                cfg.batch_size // 2 * 10, cfg.replay_buffer_num_workers, cfg.discount,  # batch size是10倍，后取top10
-                main_task=cfg.task, task_list=share_tasks)
+                (cfg.batch_size // 2 if cfg.share_prioritized or cfg.share_score_interval is not None else cfg.batch_size // 2 * 10)
+                * cfg.agent.share_reuse,  # batch size是10倍，后取top10
+                cfg.replay_buffer_num_workers, cfg.discount,
+                main_task=cfg.task, task_list=share_tasks, data_format=cfg.replay_buffer_format,
+                batched=cfg.replay_buffer_batched, relabel_cache=cfg.relabel_cache,
+                relabel_workers=cfg.relabel_workers, relabel_vectorized=cfg.relabel_vectorized,
+                device=cfg.device if cfg.replay_buffer_on_device else None,
+                producer=cfg.replay_buffer_producer, num_slots=cfg.replay_buffer_num_slots,
+                pin_memory_device=cfg.device if cfg.replay_buffer_pin_memory else None,
+                use_manifest=cfg.replay_buffer_manifest, stream_size=cfg.replay_buffer_stream_size,
+                stream_eviction=cfg.replay_buffer_stream_eviction, stream_swaps=cfg.replay_buffer_stream_swaps,
+                load_threads=cfg.replay_buffer_load_threads,
+                storage_dtype=cfg.replay_buffer_dtype, physics=cfg.replay_buffer_physics,
+                dedup=cfg.replay_buffer_dedup, prioritized=cfg.share_prioritized,
+                priority_temperature=cfg.share_priority_temperature,
+                priority_stale_after=cfg.share_priority_stale_after, score_interval=cfg.share_score_interval,
+                score_chunk=cfg.share_score_chunk, top_fraction=cfg.share_top_fraction, nstep=cfg.agent.nstep)
     replay_iter_share = iter(replay_loader_share)     # run OfflineReplayBuffer.sample function
     print("load data done.")
 
@@ -158,6 +183,10 @@ def main(cfg: DictConfig):
 
         global_step += 1
 
+    for replay_loader in [replay_loader_main, replay_loader_share]:
+        if hasattr(replay_loader, 'close'):
+            replay_loader.close()     # stops the batch producers
+
 
 if __name__ == '__main__':
     main()